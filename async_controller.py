@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import signal
+import threading
+
+import controller
+
+logger = logging.getLogger('timer_main')
+
+class AsyncController(controller.Controller):
+    """A controller that runs mqtt network I/O, the schedule timers,
+    retries and signal handling on a single asyncio event loop, so the
+    mqtt callbacks and the main loop never run concurrently and no
+    locks are needed."""
+
+    def __init__(self, mainfile, args=None):
+        super().__init__(mainfile, args)
+        global logger
+        logger = logging.getLogger(self.progname)
+        self.loop = None
+        self.wakeup_async = None    # asyncio.Event, created in run()
+        # (connected, disconnected) asyncio.Events for each connection in
+        # the pool, keyed on its index, and the file descriptor of the
+        # socket and the housekeeping task for each client with an open
+        # socket.
+        self.connection_events = {}
+        self.sockets = {}
+        self.misc_tasks = {}
+        self.loop_thread = None
+        self.stopping = False
+
+
+    async def run(self):
+        """the main loop. read the config file, connect to the broker,
+        then process remotes as their transitions come due."""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.wakeup_async = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGINT, self.stop, 'SIGINT')
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop, 'SIGTERM')
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+        self.init_controller()
+        connect_tasks = [self.loop.create_task(self.maintain_connection(conn))
+                         for conn in self.pool]
+        try:
+            while not self.stopping:
+                self.tick()
+                timeout = self.sleep_time()
+                self.planned_wake = self.loop.time() + timeout
+                try:
+                    await asyncio.wait_for(self.wakeup_async.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup_async.clear()
+        finally:
+            for task in connect_tasks:
+                task.cancel()
+            for conn in self.pool:
+                conn.client.disconnect()
+            self.shutdown()
+
+
+    def stop(self, signame):
+        """signal handler for SIGINT and SIGTERM: terminate program."""
+        logger.info(f'Received {signame}, exiting.')
+        self.stopping = True
+        self.notify()
+
+
+    def reload(self):
+        """signal handler for SIGHUP: reprocess config file."""
+        logger.info('Received SIGHUP, reloading configuration.')
+        self.init_controller()
+        self.notify()
+
+
+    def notify(self):
+        """wake the main loop early."""
+        self.wakeup_async.set()
+
+
+    def init_mqtt(self):
+        """create a client for each broker and set up callback functions,
+        and hand the clients' sockets to the event loop instead of starting
+        network threads. the connections are made by maintain_connection()."""
+        for broker, port in self.mq_brokers:
+            client = self.create_mqtt_client(len(self.pool))
+            client.on_socket_open = self.on_socket_open
+            client.on_socket_close = self.on_socket_close
+            client.on_socket_register_write = self.on_socket_register_write
+            client.on_socket_unregister_write = self.on_socket_unregister_write
+            self.pool.add(broker, port, client)
+            logger.info(f'MQTT broker {broker}:{port} topic {self.mq_topic}')
+        self.publisher.attach(self.pool)
+
+
+    async def maintain_connection(self, conn):
+        """connect to a broker in the pool, and reconnect whenever the
+        connection is lost, backing off between failed attempts. the tcp
+        connect blocks for up to paho's connect timeout when a broker does
+        not answer, so it runs in the loop's default executor, and the
+        loop carries on with the other brokers and the remotes."""
+        connected = asyncio.Event()
+        disconnected = asyncio.Event()
+        self.connection_events[conn.index] = (connected, disconnected)
+        retryInterval = 1
+        first = True
+        while True:
+            if not conn.connected:
+                try:
+                    if first:
+                        await self.loop.run_in_executor(
+                            None, conn.client.connect, conn.broker, conn.port)
+                        first = False
+                    else:
+                        await self.loop.run_in_executor(None, conn.client.reconnect)
+                    # wait for the CONNACK, or for the attempt to fail
+                    waits = [self.loop.create_task(connected.wait()),
+                             self.loop.create_task(disconnected.wait())]
+                    await asyncio.wait(waits, timeout=10,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    for w in waits:
+                        w.cancel()
+                    disconnected.clear()
+                    if not conn.connected:
+                        raise ConnectionError('no CONNACK')
+                    retryInterval = 1
+                except Exception as e:
+                    logMsg = f'Connect to broker {conn.name} failed: {str(e)}, Retry in {str(retryInterval)} seconds.'
+                    logger.error(logMsg)
+                    await asyncio.sleep(retryInterval)
+                    retryInterval = min(retryInterval * 2, 60)
+                    continue
+            connected.clear()
+            await disconnected.wait()
+            disconnected.clear()
+
+
+    def on_connect(self, mqClient, userdata, flags, reason_code, properties):
+        """The callback for when a client receives a CONNACK response from
+        its broker. if no other broker was connected, send current state to
+        the remotes. wake the main loop."""
+        was_connected = self.mqtt_connected
+        super().on_connect(mqClient, userdata, flags, reason_code, properties)
+        if reason_code.is_failure:
+            return
+        self.connection_events[self.pool.connection(mqClient).index][0].set()
+        if not was_connected:
+            self.process()
+        self.notify()
+
+
+    def on_disconnect(self, mqClient, userdata, flags, reason_code, properties):
+        """The callback for when a broker disconnects."""
+        super().on_disconnect(mqClient, userdata, flags, reason_code, properties)
+        self.connection_events[self.pool.connection(mqClient).index][1].set()
+
+
+    def call_in_loop(self, callback, *args):
+        """call callback(*args) from the event loop: at once on the loop's
+        thread, or as soon as the loop gets to it when called from a
+        connect running in the executor. paho's socket callbacks pass the
+        file descriptor, as the socket may be closed by then."""
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call_in_loop(self.add_socket, client, sock.fileno())
+
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call_in_loop(self.remove_socket, client)
+
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_writer, sock.fileno())
+
+
+    def add_socket(self, client, fd):
+        self.sockets[client] = fd
+        self.loop.add_reader(fd, client.loop_read)
+        self.misc_tasks[client] = self.loop.create_task(self.misc_loop(client))
+
+
+    def remove_socket(self, client):
+        fd = self.sockets.pop(client, None)
+        if fd is not None:
+            self.loop.remove_reader(fd)
+        task = self.misc_tasks.pop(client, None)
+        if task is not None:
+            task.cancel()
+
+
+    async def misc_loop(self, client):
+        """keepalives and other periodic client housekeeping."""
+        from paho.mqtt.client import MQTT_ERR_SUCCESS
+        while client.loop_misc() == MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
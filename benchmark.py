@@ -0,0 +1,579 @@
+import argparse
+import datetime
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import controller
+
+# the response profiles of the simulated remotes: the shortest and longest
+# delay in seconds before a remote responds to a message, and the chance
+# that it does not respond at all.
+PROFILES = {
+    'instant': (0, 0, 0),
+    'lan': (0.005, 0.05, 0),
+    'wifi': (0.02, 0.5, 0.02),
+    'lossy': (0.05, 1.0, 0.2),
+    'dead': (0, 0, 1),
+}
+
+
+def parse_args(argv=None):
+    """process command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the controller against an in-process stand-in '
+                    'for the broker and a simulated fleet of remotes.')
+    parser.add_argument('-r', '--remotes', default='10,100,1000,10000',
+        help='Comma-separated fleet sizes to run, defaults to 10,100,1000,10000.')
+    parser.add_argument('-p', '--profiles', default='lan=1',
+        help='Response profiles of the remotes with their weights, e.g. '
+             f'lan=0.9,lossy=0.09,dead=0.01. Profiles: {", ".join(PROFILES)}.')
+    parser.add_argument('-g', '--group-size', type=int, default=0,
+        help='Put the remotes in groups of this size, sharing a group topic.')
+    parser.add_argument('--random-fraction', type=float, default=0.1,
+        help='Fraction of the remotes with a random factor, defaults to 0.1.')
+    parser.add_argument('--publish-rate', type=float, default=0,
+        help='Publish rate limit in messages per second, defaults to none.')
+    parser.add_argument('--lead', type=float, default=2,
+        help='Seconds from the reload to the mass transition, defaults to 2.')
+    parser.add_argument('--downtime', type=float, default=1,
+        help='Seconds the broker is down in the reconnect storm, defaults to 1.')
+    parser.add_argument('--reconnect-spread', type=float, default=2,
+        help='Seconds over which the remotes reconnect after the broker '
+             'restarts, defaults to 2.')
+    parser.add_argument('--timeout', type=float, default=120,
+        help='Seconds to wait for each scenario to complete, defaults to 120.')
+    parser.add_argument('--log-level', default='info',
+        help='Level for the controller log, defaults to info.')
+    parser.add_argument('--seed', type=int, default=1,
+        help='Seed for the simulation, defaults to 1.')
+    parser.add_argument('--json', metavar='FILE',
+        help='Also write the results to FILE as JSON.')
+    parser.add_argument('--keep', action='store_true',
+        help='Keep the working directory with the config, log and journal files.')
+    return parser.parse_args(argv)
+
+
+def parse_profiles(text):
+    """convert name=weight,... to a list of (name, weight) tuples."""
+    profiles = []
+    for item in text.split(','):
+        name, sep, weight = item.partition('=')
+        if name not in PROFILES:
+            raise ValueError(f'unknown profile {name}')
+        profiles.append((name, float(weight) if sep else 1.0))
+    return profiles
+
+
+class FakeReasonCode:
+    """Stands in for paho's ReasonCode."""
+
+    def __init__(self, value=0):
+        self.value = value
+
+
+    @property
+    def is_failure(self):
+        return self.value >= 0x80
+
+
+    def __str__(self):
+        return 'Failure' if self.is_failure else 'Success'
+
+
+class FakeMessageInfo:
+    """Stands in for paho's MQTTMessageInfo."""
+
+    __slots__ = ('mid', 'rc')
+
+    def __init__(self, mid, rc):
+        self.mid = mid
+        self.rc = rc
+
+
+    def is_published(self):
+        return self.rc == 0
+
+
+class FakeMessage:
+    """Stands in for paho's MQTTMessage."""
+
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeClient:
+    """Stands in for a paho client connected to a FakeBroker. a publish is
+    handed to the broker at once, and on_publish is called straight away,
+    as paho does once it has written a qos 0 message to the socket."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.connected = False
+        self.mids = itertools.count(1)
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.on_publish = None
+
+
+    def reconnect_delay_set(self, min_delay, max_delay):
+        pass
+
+
+    def connect_async(self, host, port):
+        pass
+
+
+    def loop_start(self):
+        pass
+
+
+    def disconnect(self):
+        self.connected = False
+
+
+    def subscribe(self, topic):
+        self.broker.subscriber = self
+
+
+    def publish(self, topic, payload, qos=0):
+        mid = next(self.mids)
+        if not self.connected:
+            return FakeMessageInfo(mid, 4)      # MQTT_ERR_NO_CONN
+        self.broker.route(topic, payload)
+        if self.on_publish is not None:
+            self.on_publish(self, None, mid, FakeReasonCode(), None)
+        return FakeMessageInfo(mid, 0)
+
+
+class FakeBroker:
+    """An in-process stand-in for the broker and the remotes behind it.
+    each message published to a remote, or to a group topic, is answered
+    by each remote it reaches according to the remote's profile, after a
+    random delay. the answers are held in a heap until their time comes
+    and deliver_due() passes them to the subscribed client."""
+
+    def __init__(self, remotes, groups, rng):
+        self.remotes = remotes      # hostname: profile name
+        self.groups = groups        # group topic: list of hostnames
+        self.rng = rng
+        self.clients = []
+        self.subscriber = None
+        self.events = []
+        self.seq = itertools.count()
+        self.mark()
+
+
+    def mark(self):
+        """start counting publishes, acks and latencies afresh."""
+        self.published = 0
+        self.first_publish = None
+        self.last_publish = None
+        self.acked = set()          # hostnames that acked since the mark
+        self.sent = {}              # (hostname, serial): time first sent
+        self.latencies = []
+
+
+    def connect(self, client):
+        client.connected = True
+        if client not in self.clients:
+            self.clients.append(client)
+        client.on_connect(client, None, None, FakeReasonCode(), None)
+
+
+    def route(self, topic, payload):
+        now = time.monotonic()
+        self.published += 1
+        if self.first_publish is None:
+            self.first_publish = now
+        self.last_publish = now
+        word, serial = payload.split()
+        status = 'pong' if word == 'Ping' else 'ack'
+        for hostname in self.groups.get(topic, (topic,)):
+            lo, hi, drop = PROFILES[self.remotes[hostname]]
+            self.sent.setdefault((hostname, serial), now)
+            if drop and self.rng.random() < drop:
+                continue
+            self.respond(hostname, status, serial, now + self.rng.uniform(lo, hi))
+
+
+    def respond(self, hostname, status, serial, at):
+        heapq.heappush(self.events, (at, next(self.seq), hostname, status, serial))
+
+
+    def next_delivery(self):
+        """return the number of seconds until the next answer is due."""
+        if not self.events:
+            return math.inf
+        return self.events[0][0] - time.monotonic()
+
+
+    def deliver_due(self):
+        """pass the answers that are due to the subscribed client. answers
+        are lost while no client is subscribed."""
+        now = time.monotonic()
+        stamp = time.strftime('%H:%M:%S')
+        while self.events and self.events[0][0] <= now:
+            at, seq, hostname, status, serial = heapq.heappop(self.events)
+            c = self.subscriber
+            if c is None or not c.connected:
+                continue
+            if status == 'ack':
+                self.acked.add(hostname)
+                sent = self.sent.pop((hostname, serial), None)
+                if sent is not None:
+                    self.latencies.append(now - sent)
+            payload = f'{hostname} {status} {serial} {stamp} -60'
+            c.on_message(c, None, FakeMessage('timer_main', payload.encode('utf-8')))
+
+
+    def restart(self, ctl):
+        """drop every connection, as when the broker restarts. answers in
+        flight are lost."""
+        self.events.clear()
+        self.subscriber = None
+        for c in self.clients:
+            c.connected = False
+            ctl.on_disconnect(c, None, None, FakeReasonCode(0x88), None)
+
+
+    def come_back(self, spread):
+        """accept the connections again, and have each responsive remote
+        reconnect and announce itself at a random time within spread
+        seconds."""
+        for c in self.clients:
+            self.connect(c)
+        now = time.monotonic()
+        for hostname, profile in self.remotes.items():
+            if PROFILES[profile][2] < 1:
+                self.respond(hostname, 'connected', '00000000',
+                             now + self.rng.uniform(0, spread))
+
+
+class BenchController(controller.Controller):
+    """A Controller whose mqtt clients are FakeClients on a FakeBroker."""
+
+    def __init__(self, mainfile, args, broker):
+        self.broker = broker
+        super().__init__(mainfile, args)
+
+
+    def create_mqtt_client(self, index=0):
+        client = FakeClient(self.broker)
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+        return client
+
+
+    def init_mqtt(self):
+        super().init_mqtt()
+        for conn in self.pool:
+            self.broker.connect(conn.client)
+
+
+class Fleet:
+    """The simulated fleet for one run, and the config file describing it.
+    the remotes with a random factor have two items, both off, so their
+    state does not depend on the time of day; the rest are off from
+    midnight, and on from the time of the mass transition once it is set."""
+
+    def __init__(self, n, opts, workdir, rng):
+        self.names = [f'r{i:06d}' for i in range(n)]
+        names, weights = zip(*parse_profiles(opts.profiles))
+        self.profile = dict(zip(self.names, rng.choices(names, weights, k=n)))
+        n_random = int(n * opts.random_fraction)
+        self.random = set(self.names[:n_random])
+        self.group = {}
+        if opts.group_size > 1:
+            for i, name in enumerate(self.names[n_random:]):
+                self.group[name] = f'group/{i // opts.group_size}'
+        self.groups = {}
+        for name, group in self.group.items():
+            self.groups.setdefault(group, []).append(name)
+        self.opts = opts
+        self.filename = os.path.join(workdir, 'bench.yaml')
+        self.changed = None
+
+
+    def responsive(self, names=None):
+        """return the names of the remotes that answer at all."""
+        return [h for h in (names or self.names) if PROFILES[self.profile[h]][2] < 1]
+
+
+    def write(self, mass_time=None):
+        """write the config file, with the mass transition at the local
+        time mass_time (hh:mm:ss) if given, and one remote changed if
+        self.changed is set."""
+        lines = ['mqtt:', '  broker: localhost']
+        if self.opts.publish_rate:
+            lines.append(f'  publish_rate: {self.opts.publish_rate}')
+        lines += ['logging:', f'  level: {self.opts.log_level}',
+                  # short retries, so that lossy remotes converge quickly
+                  'retry:', '  initial: 1', '  min: 0.2', '  offline_after: 10',
+                  'remotes:']
+        for name in self.names:
+            if name in self.random:
+                sched = '[[0, off, all], [1200, off, all]]'
+                extra = ', random: 15'
+            else:
+                sched = '[[0, off, all]' + (f', ["{mass_time}", on, all]]' if mass_time else ']')
+                extra = f', group: {self.group[name]}' if name in self.group else ''
+            if name == self.changed:
+                sched = sched[:-1] + ', [100, off, sun]]'
+            lines.append(f'  {name}: {{sched: {sched}{extra}}}')
+        with open(self.filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Bench:
+    """Runs the scenarios for one fleet size and collects the results."""
+
+    def __init__(self, n, opts):
+        self.n = n
+        self.opts = opts
+        self.rng = random.Random(opts.seed)
+        self.workdir = tempfile.mkdtemp(prefix='timer_bench.')
+        self.fleet = Fleet(n, opts, self.workdir, self.rng)
+        self.broker = FakeBroker(self.fleet.profile, self.fleet.groups, self.rng)
+        self.fleet.write()
+        args = controller.parse_args(['--config', self.fleet.filename])
+        self.ctl = BenchController(os.path.join(self.workdir, 'benchmark.py'),
+                                   args, self.broker)
+        self.results = []
+
+
+    def drive(self, done, timeout=None):
+        """run the controller's main loop, delivering the remotes' answers,
+        until done() returns True. returns False on timeout."""
+        deadline = time.monotonic() + (timeout or self.opts.timeout)
+        while not done():
+            if time.monotonic() > deadline:
+                return False
+            self.ctl.tick()
+            self.broker.deliver_due()
+            if done():
+                break
+            wait = min(self.ctl.sleep_time(), self.broker.next_delivery(), 0.1)
+            if wait > 0:
+                time.sleep(wait)
+        return True
+
+
+    def acked(self, names):
+        """return a function that tells whether all of names have acked."""
+        names = set(names)
+        return lambda: names <= self.broker.acked
+
+
+    def record(self, scenario, elapsed, complete=True, **extra):
+        """add a result for a scenario, with the publish and ack figures
+        counted by the broker since its mark."""
+        b = self.broker
+        burst = (b.last_publish - b.first_publish) if b.published > 1 else 0
+        lat = b.latencies
+        result = {
+            'remotes': self.n,
+            'scenario': scenario,
+            'seconds': round(elapsed, 4),
+            'complete': complete,
+            'publishes': b.published,
+            'publish_rate': round(b.published / burst) if burst else None,
+            'ack_p50_ms': round(percentile(lat, 50) * 1000, 2) if lat else None,
+            'ack_p99_ms': round(percentile(lat, 99) * 1000, 2) if lat else None,
+        }
+        result.update(extra)
+        self.results.append(result)
+        print_result(result)
+
+
+    def run(self):
+        try:
+            self.startup()
+            self.steady()
+            self.reload()
+            self.mass_transition()
+            self.reconnect_storm()
+            self.rollover()
+        finally:
+            self.ctl.shutdown()
+            self.ctl.log_writer.stop()
+            logger = self.ctl.log_writer.logger
+            for h in list(logger.handlers):
+                logger.removeHandler(h)
+                h.close()
+            if self.opts.keep:
+                print(f'Files kept in {self.workdir}')
+            else:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+        return self.results
+
+
+    def startup(self):
+        """read the config file, connect and send every remote its state,
+        until all the responsive remotes have acked."""
+        self.broker.mark()
+        start = time.perf_counter()
+        self.ctl.init_controller()
+        init = time.perf_counter() - start
+        ok = self.drive(self.acked(self.fleet.responsive()))
+        self.record('startup', time.perf_counter() - start, ok, init_seconds=round(init, 4))
+
+
+    def steady(self):
+        """sweep all the remotes when nothing has changed."""
+        self.broker.mark()
+        times = []
+        for i in range(5):
+            start = time.perf_counter()
+            self.ctl.process()
+            times.append(time.perf_counter() - start)
+        self.record('steady sweep', statistics.mean(times),
+                    remotes_per_second=round(self.n / statistics.mean(times)))
+
+
+    def reload(self):
+        """SIGHUP with the config file unchanged (served from the cache),
+        and with one remote changed."""
+        for scenario, changed in (('reload unchanged', None),
+                                  ('reload one changed', self.fleet.names[-1])):
+            self.fleet.changed = changed
+            self.fleet.write()
+            self.broker.mark()
+            start = time.perf_counter()
+            self.ctl.request_reload()
+            self.ctl.tick()
+            self.record(scenario, time.perf_counter() - start)
+        self.reload_seconds = self.results[-1]['seconds']
+
+
+    def mass_transition(self):
+        """every remote without a random factor turns on at the same
+        second, as at 18:00. the config file is reloaded with the new
+        transition far enough ahead for the reload to finish first."""
+        lead = self.opts.lead + 2 * self.reload_seconds
+        target = math.ceil(time.time() + lead)
+        self.fleet.write(time.strftime('%H:%M:%S', time.localtime(target)))
+        self.broker.mark()
+        start = time.perf_counter()
+        self.ctl.request_reload()
+        self.ctl.tick()
+        reload = time.perf_counter() - start
+        if time.time() >= target:
+            print(f'warning: reload took {reload:.1f} seconds, past the mass transition')
+        names = [h for h in self.fleet.names if h not in self.fleet.random]
+        self.ctl.scheduler.stats.reset()
+        ok = self.drive(self.acked(self.fleet.responsive(names)),
+                        self.opts.timeout + lead)
+        stats = self.ctl.scheduler.stats
+        b = self.broker
+        self.record('mass transition', time.time() - target, ok,
+                    reload_seconds=round(reload, 4),
+                    dispatch_mean_ms=round(stats.total / stats.count * 1000, 2) if stats.count else None,
+                    dispatch_max_ms=round(stats.max * 1000, 2) if stats.count else None,
+                    last_publish_ms=round((b.last_publish - b.first_publish) * 1000, 2)
+                        if b.published else None)
+
+
+    def reconnect_storm(self):
+        """the broker restarts: every connection drops, and after the
+        downtime the remotes reconnect and announce themselves, and are
+        each sent their state again."""
+        self.broker.mark()
+        self.broker.restart(self.ctl)
+        self.drive(lambda: False, self.opts.downtime)
+        start = time.perf_counter()
+        self.broker.come_back(self.opts.reconnect_spread)
+        ok = self.drive(self.acked(self.fleet.responsive()),
+                        self.opts.timeout + self.opts.reconnect_spread)
+        self.record('reconnect storm', time.perf_counter() - start, ok)
+
+
+    def rollover(self):
+        """the daily rollover of the randomized schedules, driven through
+        the controller's main loop as at midnight. the randomized remotes
+        are rewound to yesterday's schedules, and a tick prepares today's.
+        each then has a transition due, as at 00:00, where its first item
+        is or is clamped to, and the tick at the change of day must both
+        dispatch them and swap in the prepared schedules."""
+        ctl = self.ctl
+        today = datetime.date.today()
+        yesterday = today - datetime.timedelta(days=1)
+        remotes = [r for r in ctl.fleet if r.random]
+        for r in remotes:
+            r.rollover(yesterday)
+        ctl.rollover_date = yesterday
+        ctl.prepare_pending = True
+        start = time.perf_counter()
+        ctl.tick()
+        prepare = time.perf_counter() - start
+        prepared = sum(r.next_date == today for r in remotes)
+        for r in remotes:
+            r.last_sched = []
+            ctl.scheduler.schedule_now(r)
+        ctl.last_mday = yesterday.day
+        self.broker.mark()
+        start = time.perf_counter()
+        ctl.tick()
+        elapsed = time.perf_counter() - start
+        # offline remotes are pinged instead
+        missed = sum(not r.last_sched and not ctl.fleet.is_offline(r.name) for r in remotes)
+        self.record('midnight rollover', elapsed, prepared == len(remotes) and not missed,
+                    prepare_seconds=round(prepare, 4), randomized=len(remotes),
+                    prepared=prepared, missed=missed)
+
+
+HEADER = f'{"remotes":>8}  {"scenario":20} {"seconds":>9} {"publishes":>9} {"msg/s":>8} {"ack p50":>8} {"ack p99":>8}  other'
+
+
+def print_result(r):
+    def opt(v, fmt):
+        return format(v, fmt) if v is not None else '-'
+    other = '  '.join(f'{k}={v}' for k, v in r.items()
+                      if k not in ('remotes', 'scenario', 'seconds', 'publishes',
+                                   'publish_rate', 'ack_p50_ms', 'ack_p99_ms', 'complete'))
+    if not r['complete']:
+        other = 'INCOMPLETE  ' + other
+    print(f'{r["remotes"]:8d}  {r["scenario"]:20} {r["seconds"]:9.4f} {r["publishes"]:9d} '
+          f'{opt(r["publish_rate"], "8d")} {opt(r["ack_p50_ms"], "8.2f")} '
+          f'{opt(r["ack_p99_ms"], "8.2f")}  {other}', flush=True)
+
+
+def main():
+    opts = parse_args()
+    try:
+        sizes = [int(s) for s in opts.remotes.split(',')]
+        parse_profiles(opts.profiles)
+    except ValueError as e:
+        print(f'benchmark: {str(e)}')
+        sys.exit(2)
+    results = []
+    print(HEADER)
+    for n in sizes:
+        results += Bench(n, opts).run()
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import hashlib
+import threading
+
+
+def parse_brokers(mqtt_d):
+    """return a list of (broker, port) tuples from the mqtt block of the
+    config file. the optional brokers list has entries given as "host",
+    "host:port" or {broker: host, port: port}; without it, the broker and
+    port settings give a single broker. raises an exception if the block
+    is not structured as expected."""
+    default_port = mqtt_d.get('port', 1883)
+    entries = mqtt_d.get('brokers') or [mqtt_d['broker']]
+    brokers = []
+    for e in entries:
+        if isinstance(e, dict):
+            brokers.append((str(e['broker']), int(e.get('port', default_port))))
+        else:
+            host, sep, port = str(e).rpartition(':')
+            if sep and port.isdigit():
+                brokers.append((host, int(port)))
+            else:
+                brokers.append((str(e), default_port))
+    if len(set(brokers)) != len(brokers):
+        raise ValueError('duplicate broker in mqtt block')
+    return brokers
+
+
+class Connection:
+    """One of the connections in a BrokerPool."""
+
+    __slots__ = ('index', 'broker', 'port', 'client', 'connected', 'generation')
+
+    def __init__(self, index, broker, port, client):
+        self.index = index
+        self.broker = broker
+        self.port = port
+        self.client = client
+        self.connected = False
+        self.generation = 0     # incremented when the connection is lost
+
+
+    @property
+    def name(self):
+        return f'{self.broker}:{self.port}'
+
+
+class BrokerPool:
+    """A connection to each of the brokers, all kept open, so that when
+    one drops the others are already connected and take over straight
+    away. publishes are spread across the connected brokers by a key,
+    each key going to the connected broker with the highest rendezvous
+    hashing weight for it, so that the messages for a remote keep their
+    order through bridged brokers, and only the keys of a broker that
+    drops move to the others.
+    one connected broker at a time carries the subscription to the topic
+    the remotes respond on, so that with clustered or bridged brokers each
+    response is received once; when it drops, another one takes over."""
+
+    def __init__(self):
+        self.connections = []
+        self.by_client = {}
+        self.subscriber = None
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.connections)
+
+
+    def __iter__(self):
+        return iter(self.connections)
+
+
+    def add(self, broker, port, client):
+        """add a connection to the pool and return it."""
+        conn = Connection(len(self.connections), broker, port, client)
+        self.connections.append(conn)
+        self.by_client[client] = conn
+        return conn
+
+
+    def connection(self, client):
+        """return the Connection for a paho client."""
+        return self.by_client[client]
+
+
+    def is_connected(self):
+        """return True if any of the brokers is connected."""
+        return any(conn.connected for conn in self.connections)
+
+
+    def mark_connected(self, conn):
+        """mark a connection connected. returns True if it should carry
+        the subscription, because no other connection does."""
+        with self.lock:
+            conn.connected = True
+            if self.subscriber is None:
+                self.subscriber = conn
+                return True
+            return False
+
+
+    def mark_disconnected(self, conn):
+        """mark a connection disconnected. if it carried the subscription,
+        returns the connected Connection that should take it over, if any,
+        else returns None."""
+        with self.lock:
+            conn.connected = False
+            if self.subscriber is not conn:
+                return None
+            self.subscriber = next((c for c in self.connections if c.connected), None)
+            return self.subscriber
+
+
+    def route(self, key):
+        """return the connected Connection for key, or the first one if
+        none is connected."""
+        connected = [c for c in self.connections if c.connected]
+        if len(connected) == 1:
+            return connected[0]
+        if not connected:
+            return self.connections[0]
+        return max(connected, key=lambda c: weight(c.index, key))
+
+
+    def publish(self, topic, payload, qos=0, key=None):
+        """publish on the connected broker for key (default topic).
+        returns the Connection that was used and the MQTTMessageInfo."""
+        conn = self.route(topic if key is None else key)
+        return conn, conn.client.publish(topic, payload, qos=qos)
+
+
+def weight(index, key):
+    """return the rendezvous hashing weight of key for a connection."""
+    h = hashlib.blake2b(f'{index}:{key}'.encode('utf-8'), digest_size=8)
+    return int.from_bytes(h.digest(), 'big')
@@ -0,0 +1,250 @@
+import hashlib
+import logging
+import os
+import pickle
+
+logger = logging.getLogger('timer_main')
+
+# stored with the cached configs, and changed when the way the files are
+# parsed changes, so that older caches are parsed again.
+CACHE_VERSION = 3
+
+# the YAML loader class, made by yaml_loader()
+_loader = None
+
+
+def yaml_loader():
+    """return the YAML loader, made from the C loader if PyYAML was built
+    with it. it reads plain scalars with colons, such as 18:00, as strings
+    rather than as YAML 1.1 base 60 numbers (1080), and integers with a
+    leading zero, such as 0705, as decimal rather than octal (453), either
+    of which would pass for a different time. yaml is imported here so
+    that a cached config does not need it."""
+    global _loader
+    if _loader is None:
+        import re
+        import yaml
+        base = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        int_tag = 'tag:yaml.org,2002:int'
+        numbers = (int_tag, 'tag:yaml.org,2002:float')
+        leading_zero = re.compile(r'[-+]?0[0-9]+$')
+
+        class Loader(base):
+            def resolve(self, kind, value, implicit):
+                tag = super().resolve(kind, value, implicit)
+                if tag in numbers and ':' in value:
+                    return self.DEFAULT_SCALAR_TAG
+                if kind is yaml.ScalarNode and implicit[0] and leading_zero.match(value):
+                    return int_tag
+                return tag
+
+            def construct_yaml_int(self, node):
+                if leading_zero.match(node.value):
+                    return int(node.value)
+                return super().construct_yaml_int(node)
+
+        Loader.add_constructor(int_tag, Loader.construct_yaml_int)
+        _loader = Loader
+    return _loader
+
+
+def parse_yaml(text):
+    """parse YAML text with the loader from yaml_loader()."""
+    import yaml
+    return yaml.load(text, Loader=yaml_loader())
+
+
+def load(filename, cache_filename=None):
+    """read the config file and return it as a dictionary. if
+    cache_filename is given, the parsed result is cached there, keyed
+    on a hash of the file contents, and the cache is used instead of
+    parsing when the contents have not changed. raises an exception
+    if the file cannot be read or parsed."""
+    with open(filename, 'rb') as f:
+        text = f.read()
+    digest = hashlib.sha256(text).hexdigest()
+
+    if cache_filename is not None:
+        try:
+            with open(cache_filename, 'rb') as f:
+                version, cached_digest, d = pickle.load(f)
+            if version == CACHE_VERSION and cached_digest == digest:
+                logger.debug(f'Config file loaded from cache: {filename}')
+                return d
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            pass
+
+    d = parse_yaml(text)
+    logger.debug(f'Config file parsed successfully: {filename}')
+
+    if cache_filename is not None:
+        tmp = f'{cache_filename}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump((CACHE_VERSION, digest, d), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_filename)
+        except (OSError, pickle.PicklingError) as e:
+            logger.warning(f'Config cache write failed: {str(e)}')
+    return d
+
+
+# with at least this many files to parse, and more than one CPU, they are
+# parsed in parallel. starting the worker processes takes a fraction of a
+# second, which parsing fewer files would not repay.
+PARALLEL_FILES = 256
+
+
+def parse_remotes_file(path):
+    """read and parse a file from the remotes directory, and return its
+    remotes as a dictionary keyed on name. the file has a remotes block
+    as in the config file, and optionally a group topic for the remotes
+    in it that do not give their own. each remote is checked as it will
+    be when the config is applied. raises ValueError naming the file if
+    it cannot be read, parsed or checked."""
+    import remote
+    try:
+        with open(path, 'rb') as f:
+            d = parse_yaml(f.read()) or {}
+        remotes = d.get('remotes') or {}
+        if not isinstance(remotes, dict):
+            raise ValueError('remotes block is not a mapping')
+        group = d.get('group')
+        for name, props in remotes.items():
+            if group is not None and 'group' not in props:
+                props['group'] = group
+            remote.normalize(props)
+    except Exception as e:
+        raise ValueError(f'{path}: {str(e)}')
+    return remotes
+
+
+class RemotesDir:
+    """The remotes from a conf.d style directory of YAML files, e.g. one
+    for each remote or group, that add to the remotes block of the config
+    file. the parsed and checked remotes from each file are cached, keyed
+    on its path, modification time and size, so that a reload parses only
+    the files that changed, in parallel when there are many of them. the
+    cache is kept in cache_filename, if given, across restarts.
+    the remotes from an unchanged file are the same dictionaries as the
+    last time, which lets the controller skip comparing them."""
+
+    def __init__(self):
+        # path: (mtime_ns, size, remotes)
+        self.files = {}
+        self.loaded_cache = False
+
+
+    def load_cache(self, cache_filename):
+        try:
+            with open(cache_filename, 'rb') as f:
+                version, files = pickle.load(f)
+            if version == CACHE_VERSION:
+                self.files = files
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            self.files = {}
+
+
+    def save_cache(self, cache_filename):
+        tmp = f'{cache_filename}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump((CACHE_VERSION, self.files), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_filename)
+        except (OSError, pickle.PicklingError) as e:
+            logger.warning(f'Remotes directory cache write failed: {str(e)}')
+
+
+    def load(self, dirname, cache_filename=None):
+        """return the remotes from the .yaml and .yml files in dirname, in
+        file name order, as a dictionary keyed on name. raises ValueError
+        if a file cannot be parsed or a remote is in more than one file."""
+        if cache_filename is not None and not self.loaded_cache:
+            self.loaded_cache = True
+            self.load_cache(cache_filename)
+        stats = {}
+        for entry in os.scandir(dirname):
+            if entry.name.endswith(('.yaml', '.yml')) and not entry.name.startswith('.') \
+                    and entry.is_file():
+                st = entry.stat()
+                stats[entry.path] = (st.st_mtime_ns, st.st_size)
+        stale = [path for path, stat in stats.items()
+                 if self.files.get(path, (None, None))[:2] != stat]
+        cpus = os.cpu_count() or 1
+        if len(stale) >= PARALLEL_FILES and cpus > 1:
+            # worker processes are started fresh rather than forked, as
+            # the program has other threads running.
+            import concurrent.futures
+            import multiprocessing
+            with concurrent.futures.ProcessPoolExecutor(
+                    mp_context=multiprocessing.get_context('spawn')) as pool:
+                parsed = list(pool.map(parse_remotes_file, stale,
+                                       chunksize=max(1, len(stale) // (4 * cpus))))
+        else:
+            parsed = [parse_remotes_file(path) for path in stale]
+        for path, remotes in zip(stale, parsed):
+            self.files[path] = stats[path] + (remotes,)
+        removed = self.files.keys() - stats.keys()
+        for path in removed:
+            del self.files[path]
+        if (stale or removed) and cache_filename is not None:
+            self.save_cache(cache_filename)
+        logger.debug(f'Remotes directory {dirname}: {len(stats)} files, '
+                     f'{len(stale)} parsed, {len(removed)} removed.')
+
+        remotes = {}
+        for path in sorted(stats):
+            file_remotes = self.files[path][2]
+            for name in file_remotes:
+                if name in remotes:
+                    raise ValueError(f'remote {name} is in more than one file in {dirname}')
+            remotes.update(file_remotes)
+        return remotes
+
+
+def git_version(path):
+    """return the short hash, author date and author name of the current
+    git commit in path, as from git log -1 --format="%h %ai %an", reading
+    the repository files directly instead of running git. if the commit
+    object is packed, only the short hash is returned. returns an empty
+    string if path is not in a git work tree."""
+    import datetime
+    import zlib
+    gitdir = os.path.join(path, '.git')
+    try:
+        with open(os.path.join(gitdir, 'HEAD')) as f:
+            head = f.read().strip()
+        if head.startswith('ref: '):
+            ref = head[5:]
+            try:
+                with open(os.path.join(gitdir, ref)) as f:
+                    sha = f.read().strip()
+            except FileNotFoundError:
+                sha = ''
+                with open(os.path.join(gitdir, 'packed-refs')) as f:
+                    for line in f:
+                        if line.rstrip().endswith(' ' + ref):
+                            sha = line.split()[0]
+                            break
+        else:
+            sha = head
+    except OSError:
+        return ''
+    if not sha:
+        return ''
+
+    try:
+        with open(os.path.join(gitdir, 'objects', sha[:2], sha[2:]), 'rb') as f:
+            obj = zlib.decompress(f.read())
+    except (OSError, zlib.error):
+        return sha[:7]
+    for line in obj.split(b'\n'):
+        if line.startswith(b'author '):
+            # author Name <email> 1700000000 +0100
+            name, rest = line[7:].decode('utf-8', 'replace').rsplit('<', 1)
+            stamp, tz = rest.split('>', 1)[1].split()
+            offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+            if tz[0] == '-':
+                offset = -offset
+            when = datetime.datetime.fromtimestamp(int(stamp), datetime.timezone(offset))
+            return f'{sha[:7]} {when.strftime("%Y-%m-%d %H:%M:%S")} {tz} {name.strip()}'
+    return sha[:7]
@@ -1,107 +1,230 @@
 import argparse
 import datetime
 import logging
-import logging.handlers
-import paho.mqtt.client as mqtt
 import os
 import random
 import socket
 import sys
+import threading
 import time
-import yaml
 
+import broker_pool
+import configfile
+import fleet
+import journal
+import logwriter
+import metrics
+import publisher
 import remote
+import retry
+import scheduler
+import shard
 
 logger = logging.getLogger('timer_main')
 
-class Controller:
-    """A class to manage and communicate with one or more remotes."""
-
-    def __init__(self, mainfile):
-        """set up logging, process command line arguments"""
+# status messages that ask for a remote to be processed are collected
+# for this many seconds, so a burst of them is handled in one pass.
+COALESCE_SECONDS = 0.5
+
+# when the wall clock moves by more than this many seconds more or less
+# than the monotonic clock between two passes of the main loop, it has
+# been stepped, and every remote is rescheduled.
+CLOCK_JUMP_SECONDS = 2
+
+# the longest the main loop sleeps, so that a step of the wall clock is
+# noticed within this many seconds.
+MAX_SLEEP_SECONDS = 60
+
+# a transition dispatched later than this many seconds is logged.
+LATE_WARNING_SECONDS = 1
+
+
+def parse_args(argv=None):
+    """process command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Timer main: Control program for remote timers.',
+        epilog='Manages schedules and communicates with one or more remote timers.')
+    parser.add_argument('-s', '--syntax', action='store_true',
+        help='Check config file for syntax errors and exit.')
+    parser.add_argument('-c', '--config', default='config.yaml',
+        help='Optional config file name, defaults to config.yaml.')
+    parser.add_argument('-a', '--asyncio', action='store_true',
+        help='Run MQTT, timers and signals on a single asyncio event loop.')
+    parser.add_argument('-d', '--date', type=datetime.date.fromisoformat,
+        help='With --syntax, randomize schedules starting from this date (YYYY-MM-DD).')
+    parser.add_argument('--at', metavar='"DAY HH:MM"',
+        help='With --syntax, print the state of every remote at this time, e.g. "sat 23:00".')
+    parser.add_argument('--until', metavar='"DAY HH:MM"',
+        help='With --at, also print every change of state from the --at time up to this time.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help='Split the remotes across this many worker processes.')
+    parser.add_argument('--shard', type=shard.parse_shard, metavar='I/N',
+        help='Run as worker I of N, managing only the remotes it owns.')
+    # --verbose combined with --syntax prints the weekly schedules.
+    parser.add_argument('-v', '--verbose', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def init_logging(log_filename, name):
+    """log to a file that is rotated at midnight, keeping a week of logs.
+    returns the LogWriter, which the logging block of the config file
+    configures."""
+    return logwriter.LogWriter(logging.getLogger(name), log_filename)
 
-        # a list containing all the Remote objects
-        self.remotes = []
 
-        # a dictionary containing schedules that have been sent to a remote
-        # but not acknowledged. dictionary items consist of:
-        # hex_serial: [retries_left, hostname, sched_list]
-        self.retry = {}
-
-        # a list of remote hostnames that are considered offline
-        # because they have not responded to a message. when a remote
-        # is added to the offline list, any retries for that hostname
-        # are removed from the retry dictionary.
-        self.offline = []
+class Controller:
+    """A class to manage and communicate with one or more remotes."""
 
-        # the mqtt client and associated parameters
-        self.mqClient = None
+    def __init__(self, mainfile, args=None):
+        """set up logging, process command line arguments
+        (unless already processed by the caller)"""
+
+        # all the Remote objects keyed on hostname, and the set of
+        # hostnames that are considered offline because they have not
+        # responded to a message. when a remote is marked offline,
+        # any retries for that hostname are removed.
+        self.fleet = fleet.Fleet()
+
+        # schedules that have been sent to a remote but not acknowledged,
+        # indexed by hostname and serial, with their retry deadlines.
+        self.retries = retry.RetryManager()
+
+        # an on-disk record of the last schedule acknowledged by each remote,
+        # schedules in flight and offline remotes, read back at startup.
+        self.journal = journal.Journal()
+        self.journal_loaded = False
+
+        # messages waiting to be published, and the delivery status of the
+        # last schedule published to each remote.
+        self.publisher = publisher.Publisher()
+        self.publisher.on_ready = self.notify
+
+        # counters and histograms for the hot paths, and gauges of the
+        # controller's state, served over http if enabled.
+        self.metrics = metrics.Metrics()
+        self.metrics.gauge('remotes', 'Remotes managed.', lambda: len(self.fleet))
+        self.metrics.gauge('remotes_offline', 'Remotes marked offline.',
+                           lambda: len(self.fleet.offline))
+        self.metrics.gauge('retries_in_flight', 'Schedules sent and not acknowledged.',
+                           lambda: len(self.retries))
+        self.metrics.gauge('publish_queue', 'Messages waiting to be published.',
+                           lambda: self.publisher.pending())
+        self.metrics.gauge('brokers_connected', 'Brokers connected.',
+                           lambda: sum(conn.connected for conn in self.pool))
+        # the monotonic time the main loop means to wake from its sleep
+        self.planned_wake = None
+
+        # the enabled remotes, keyed on the time of their next transition.
+        # schedule transitions and the offline pings are timed on the wall
+        # clock, as they are tied to the time of day; retries, the
+        # coalescing window, the publish rate and journal flushes are
+        # timed on the monotonic clock, so that they are not upset when
+        # the wall clock is stepped.
+        self.scheduler = scheduler.TransitionScheduler(self.metrics.dispatch_lateness)
+
+        # time for the next ping of the offline remotes,
+        # the day of the month for the daily rollover, the date of the last
+        # rollover, and whether the next day's randomized schedules need
+        # to be prepared.
+        self.next_ping = 0
+        self.reload_requested = False
+        self.last_mday = time.localtime().tm_mday
+        self.rollover_date = datetime.date.today()
+        self.prepare_pending = False
+
+        # the (wall, monotonic) clock readings at the last pass of the main
+        # loop, and the local time's offset from UTC in seconds, to notice
+        # steps of the wall clock and changes to or from daylight saving.
+        self.last_clocks = None
+        self.utc_offset = time.localtime().tm_gmtoff
+
+        # seed for the random schedule adjustments
+        self.random_seed = 0
+
+        # the remotes from the config's remotes directory, parsed only for
+        # the files that changed, and the props each remote was last built
+        # from, so that one from an unchanged file can be kept unexamined.
+        self.remotes_dir = configfile.RemotesDir()
+        self.config_props = {}
+
+        # set by notify() to wake the main loop before its next deadline
+        self.wakeup = threading.Event()
+
+        # hostnames of remotes waiting to be processed because of a status
+        # message, and the time the first of them arrived plus the
+        # coalescing window. on_message adds to the set, which is
+        # swapped out under the lock by process_pending().
+        self.pending = set()
+        self.pending_deadline = 0
+        self.pending_lock = threading.Lock()
+
+        # a connection to each mqtt broker, whether any of them is
+        # connected, and associated parameters
+        self.pool = broker_pool.BrokerPool()
         self.mqtt_connected = False
-        self.mq_broker = ''
-        self.mq_port = 0
+        self.mq_brokers = []
         self.mq_topic = ''
 
+        # process command line arguments
+        self.args = args if args is not None else parse_args()
+
+        # when running as one of several workers, the (index, workers)
+        # tuple for this worker. each worker has its own log, pid, cache
+        # and journal files, named with its index.
+        self.shard = self.args.shard
+        # the hostnames in the config file that other workers manage
+        self.others = set()
+
         # various informational stuff
         self.progpath = os.path.dirname(os.path.realpath(mainfile))
         self.prognamepy = os.path.basename(sys.argv[0])  # name.py
         self.progname = self.prognamepy.split(sep='.')[0]     # name only
         # get the git hash for the current commit
-        cmd = os.popen(f'git -C {self.progpath} log -1 --format="%h %ai %an"')
-        self.git_hash = cmd.read().replace('\n', '')
-        cmd.close()
+        self.git_hash = configfile.git_version(self.progpath)
         version_info = f'{self.prognamepy} PID {str(os.getpid())} {self.git_hash}'
-        log_filename = f'{self.progpath}{os.sep}{self.progname}.log'
-        self.pid_filename = f'{self.progpath}{os.sep}{self.progname}.pid'
-        self.days = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+        if self.shard is not None:
+            version_info += f' shard {self.shard[0]}/{self.shard[1]}'
+        log_filename = self.shard_filename(f'{self.progpath}{os.sep}{self.progname}.log')
+        self.cache_filename = self.shard_filename(f'{self.progpath}{os.sep}.{self.progname}.cache')
+        self.dir_cache_filename = self.shard_filename(f'{self.progpath}{os.sep}.{self.progname}.dircache')
+        self.pid_filename = self.shard_filename(f'{self.progpath}{os.sep}{self.progname}.pid')
 
         # set up logging
         global logger
-        logger = logging.getLogger(self.progname)
-        logger.setLevel(logging.DEBUG)
-        handler = logging.handlers.TimedRotatingFileHandler(
-                log_filename, when='midnight', backupCount=7)
-        logger.addHandler(handler)
-        f = logging.Formatter(
-                fmt='%(asctime)s.%(msecs)03d\t%(levelname)s\t%(message)s',
-                datefmt='%Y-%m-%d %H:%M:%S')
-        handler.setFormatter(f)
+        self.log_writer = init_logging(log_filename, self.progname)
+        logger = self.log_writer.logger
         logger.info(f'Start {version_info}')
         logger.debug(f'Working directory is {os.getcwd()}')
-
-        # process command line arguments
-        parser = argparse.ArgumentParser(
-            description='Timer main: Control program for remote timers.',
-            epilog='Manages schedules and communicates with one or more remote timers.')
-        parser.add_argument('-s', '--syntax', action='store_true',
-            help='Check config file for syntax errors and exit.')
-        parser.add_argument('-c', '--config', default='config.yaml',
-            help='Optional config file name, defaults to config.yaml.')
-        # --verbose combined with --syntax prints the weekly schedules.
-        parser.add_argument('-v', '--verbose', action='store_true', help=argparse.SUPPRESS)
-        self.args = parser.parse_args()
         self.write_pidfile()
 
 
+    def shard_filename(self, filename):
+        """return the name of this worker's own copy of filename."""
+        return shard.shard_filename(filename, self.shard)
+
+
+    def owns(self, hostname, group=None):
+        """return True if hostname, in the given group, is managed by this
+        process."""
+        return self.shard is None or \
+            shard.owner(hostname, self.shard[1], group) == self.shard[0]
+
+
     def init_controller(self):
         """reads the configuration file and creates Remote objects.
         exits if it's just a syntax check, else initializes mqtt and
-        processes the remotes."""
-
-        # in case we were called to reload the config file, start with
-        # a fresh list of remotes, clear the retry dict and offline list.
-        for r in self.remotes:
-            del r
-        self.remotes = []
-        self.retry = {}
-        self.offline = []
+        processes the remotes.
+        when called to reload the config file, only the remotes whose
+        config changed (or that have a random factor, if the random seed
+        changed) are rebuilt and processed. the others keep their retries,
+        offline status and last schedule sent."""
+        start = time.perf_counter()
 
         # read the config file and convert to a dictionary object (d).
         try:
             filename = self.args.config
-            d = {}
-            with open(filename, 'r') as yamlfile:
-                d = yaml.safe_load(yamlfile)
-                logger.debug(f'Config file parsed successfully: {filename}')
+            d = configfile.load(filename,
+                None if self.args.syntax else self.cache_filename)
         except Exception as e:
             logger.error(f'Error parsing config file {filename}: {str(e)}')
             if self.args.syntax:
@@ -112,93 +235,309 @@ class Controller:
         # if they do not exist, then generate an error.
         try:
             mqtt_d = d['mqtt']
-            remotes_d = d['remotes']
-            self.mq_broker = mqtt_d['broker']
-            self.mq_port = mqtt_d.get('port', 1883)
+            dirname = d.get('remotes_dir')
+            if dirname is None:
+                remotes_d = d['remotes']
+            else:
+                remotes_d = dict(d.get('remotes') or {})
+                dirname = os.path.join(os.path.dirname(os.path.abspath(filename)), dirname)
+                for k, v in self.remotes_dir.load(dirname,
+                        None if self.args.syntax else self.dir_cache_filename).items():
+                    if k in remotes_d:
+                        raise ValueError(f'remote {k} is in the config file and in {dirname}')
+                    remotes_d[k] = v
+            self.mq_brokers = broker_pool.parse_brokers(mqtt_d)
             self.mq_topic = mqtt_d.get('topic', self.progname)
+            self.publisher.configure(
+                qos=mqtt_d.get('qos', 0),
+                rate=mqtt_d.get('publish_rate', 0),
+                burst=mqtt_d.get('publish_burst', 100),
+                window=mqtt_d.get('publish_window', 0))
+            seed = d.get('random_seed', 0)
+            journal_d = d.get('journal') or {}
+            journal_file = None
+            if journal_d.get('enabled', True) and not self.args.syntax:
+                journal_file = self.shard_filename(journal_d.get('file',
+                    f'{self.progpath}{os.sep}{self.progname}.journal'))
+            self.journal.configure(journal_file,
+                flush_interval=journal_d.get('flush_interval', 10),
+                compact_size=journal_d.get('compact_size', 1000000))
+            logging_d = d.get('logging') or {}
+            event_log = logging_d.get('event_log', False)
+            if event_log is True:
+                event_log = f'{self.progpath}{os.sep}{self.progname}.events.jsonl'
+            self.log_writer.configure(
+                level=logging_d.get('level', 'debug'),
+                background=logging_d.get('background', True),
+                flush_interval=logging_d.get('flush_interval', 1),
+                event_log=self.shard_filename(event_log)
+                    if event_log and not self.args.syntax else None)
+            metrics_d = d.get('metrics') or {}
+            if metrics_d.get('enabled', False) and not self.args.syntax:
+                port = metrics_d.get('port', 9105)
+                if self.shard is not None:
+                    port += self.shard[0]
+                self.metrics.serve(metrics_d.get('address', '127.0.0.1'), port)
+            else:
+                self.metrics.serve(None, None)
+            retry_d = d.get('retry') or {}
+            self.retries.configure(
+                retries=retry_d.get('retries', 3),
+                initial=retry_d.get('initial', 5),
+                factor=retry_d.get('factor', 2),
+                minimum=retry_d.get('min', 0.5),
+                maximum=retry_d.get('max', 60),
+                max_inflight=retry_d.get('max_inflight', 2),
+                offline_after=retry_d.get('offline_after', 60),
+                weak_rssi=retry_d.get('weak_rssi', -80))
         except Exception as e:
             logger.error(f'Config file error: {str(e)}')
             if self.args.syntax:
                 print(f'Config file error: {str(e)}')
             sys.exit(1)
 
-        # instantiate Remote objects and add them to the list
+        # instantiate Remote objects for new and changed remotes, and keep
+        # the existing objects for the rest.
+        remotes = []
+        changed = []
+        others = set()
+        date = self.args.date if self.args.syntax and self.args.date else datetime.date.today()
         for k, v in remotes_d.items():
-            r = remote.Remote(k, v)
+            if self.shard is not None and not self.owns(k,
+                    v.get('group') if isinstance(v, dict) else None):
+                others.add(k)
+                continue
+            old = self.fleet.get(k)
+            try:
+                # props from an unchanged file in the remotes directory are
+                # the same object as last time, and need not be normalized.
+                unchanged = old is not None \
+                    and (self.config_props.get(k) is v or old.key == remote.normalize(v)) \
+                    and not (old.random and old.seed != seed)
+            except Exception:
+                unchanged = False
+            if unchanged:
+                remotes.append(old)
+                continue
+            r = remote.Remote(k, v, seed, date)
             if r.name == 'error':
                 if self.args.syntax:
                     print('\nParse failed!')
                     print(f'Unexpected structure in config file: {r.error_msg}')
                 sys.exit(1)
-            else:
-                self.remotes.append(r)
+            # the state last sent still applies if it is in the new schedule
+            if old is not None:
+                r.last_sched = old.last_sched
+            remotes.append(r)
+            changed.append(r)
+
+        # drop the remotes that are no longer in the config file
+        self.config_props = remotes_d
+        self.others = others
+        self.random_seed = seed
+        if any(r.random for r in changed):
+            self.prepare_pending = True
+        removed = self.fleet.update(remotes)
+        for r in removed:
+            self.retries.cancel_host(r.name)
+            self.retries.forget(r.name)
+            self.scheduler.remove(r)
+            self.journal.drop(r.name)
+            self.publisher.forget(r.name)
+        logger.debug(f'{len(changed)} remotes new or changed, {len(removed)} removed.')
 
         # if syntax check, print the config information.
         if self.args.syntax:
             print(f'\nConfiguration file parsed successfully: {filename}')
-            for r in self.remotes:
-                r.print(self.args.verbose)
+            self.print_fleet()
+            if self.args.workers > 1:
+                self.print_shards()
             logger.info('Exiting: Syntax check only.')
             sys.exit(0)
 
         if not self.args.syntax:
-            if not self.mqtt_connected:
+            if not self.journal_loaded:
+                self.journal_loaded = True
+                self.restore_journal()
+            if not self.pool:
                 self.init_mqtt()
-                time.sleep(1)
-            self.process()
+            # the new and changed remotes are due now
+            now = time.time()
+            for r in changed:
+                if r.enabled:
+                    self.scheduler.schedule_now(r, now)
+                else:
+                    self.retries.cancel_host(r.name)
+                    self.scheduler.remove(r)
+            # (without a connection, the messages wait in the publisher)
+            self.process_due()
+            self.metrics.reload_seconds.observe(time.perf_counter() - start)
+
+
+    def print_fleet(self):
+        """print the config information for the syntax check. with numpy,
+        --verbose prints a timeline for the whole fleet rather than the
+        weekly schedule of each remote, and --at prints the state of each
+        remote at a given time."""
+        import fleetmatrix
+        matrix = None
+        if fleetmatrix.np is not None and (self.args.verbose or self.args.at):
+            matrix = fleetmatrix.FleetMatrix(self.fleet)
+        for r in self.fleet:
+            r.print(self.args.verbose and matrix is None)
+        if matrix is not None and self.args.verbose:
+            matrix.print_timeline()
+        if self.args.at:
+            option = '--at'
+            until = None
+            try:
+                sow = fleetmatrix.parse_when(self.args.at)
+                if self.args.until:
+                    option = '--until'
+                    until = fleetmatrix.parse_when(self.args.until)
+            except ValueError as e:
+                print(f'\n{option}: {str(e)}')
+                sys.exit(1)
+            if matrix is not None:
+                states = [matrix.state_values[c] if c >= 0 else None
+                          for c in matrix.states_at(sow)]
+            else:
+                states = [(r.compiled.current(sow) or (None, None))[1] for r in self.fleet]
+            print(f'\nState at {fleetmatrix.format_sow(sow)}:')
+            for r, state in zip(self.fleet, states):
+                print(f'{r.name}: {state}')
+            if until is not None:
+                if matrix is not None:
+                    changes = matrix.transitions_between(sow, until)
+                else:
+                    changes = self.transitions_between(sow, until)
+                print(f'\nChanges from {fleetmatrix.format_sow(sow)} '
+                      f'to {fleetmatrix.format_sow(until)}:')
+                for t, name, state in changes:
+                    print(f'{fleetmatrix.format_sow(t):12}  {name}: {state}')
+        elif self.args.until:
+            print('\n--until: requires --at')
+            sys.exit(1)
+
+
+    def transitions_between(self, start, end):
+        """return a list of (sow, name, state) for every schedule item
+        taking effect from second of week start up to but not including
+        end, in time order, for the syntax check without numpy."""
+        span = (end - start) % remote.SECONDS_PER_WEEK
+        changes = [(t, r.name, item[1]) for r in self.fleet
+                   for t, item in zip(r.compiled.seconds, r.compiled.items)
+                   if (t - start) % remote.SECONDS_PER_WEEK < span]
+        changes.sort(key=lambda c: (c[0] - start) % remote.SECONDS_PER_WEEK)
+        return changes
+
+
+    def print_shards(self):
+        """print the number of remotes each worker would manage."""
+        counts = [0] * self.args.workers
+        for r in self.fleet:
+            counts[shard.owner(r.name, self.args.workers, r.group)] += 1
+        print(f'\nRemotes per worker:')
+        for i, n in enumerate(counts):
+            print(f'{i}: {n}')
+
+
+    def restore_journal(self):
+        """restore the last schedule sent to each remote, the schedules in
+        flight and the offline remotes from the journal, so that after a
+        restart we only send what changed while we were down."""
+        self.journal.load()
+        now = time.monotonic()
+        for hostname, sched in self.journal.acked.items():
+            r = self.fleet.get(hostname)
+            if r is not None:
+                r.last_sched = sched
+        for hostname, (serial, sched) in self.journal.inflight.items():
+            r = self.fleet.get(hostname)
+            if r is not None and r.enabled:
+                self.retries.add(hostname, serial, sched, now)
+                r.last_sched = sched
+        for hostname in self.journal.offline:
+            if hostname in self.fleet:
+                self.fleet.mark_offline(hostname)
+
+
+    def create_mqtt_client(self, index=0):
+        """create an mqtt client for the broker at index in the pool and
+        set up callback functions. each client needs its own client id.
+        paho is imported here, so that it is not loaded for a syntax check."""
+        import paho.mqtt.client as mqtt
+        client_id = f'{self.prognamepy}@{socket.gethostname()}'
+        if self.shard is not None:
+            client_id += f'/{self.shard[0]}'
+        if index:
+            client_id += f'#{index}'
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, \
+            client_id=client_id, clean_session=True)
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+        return client
 
 
     def init_mqtt(self):
-        """set up callback functions and start mqtt."""
-
-        self.mqClient = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, \
-            client_id=f'{self.prognamepy}@{socket.gethostname()}', clean_session=True)
-        self.mqClient.on_connect = self.on_connect
-        self.mqClient.on_message = self.on_message
-        self.mqClient.on_disconnect = self.on_disconnect
-        self.mqClient.loop_start()
-
-        # connect to broker
-        logger.info(f'MQTT broker {self.mq_broker}:{self.mq_port} topic {self.mq_topic}')
-        retryInterval = 10
-        nTry = 0
-        while (not self.mqtt_connected):
-            try:
-                nTry += 1
-                self.mqClient.connect(self.mq_broker, self.mq_port)
-                time.sleep(1)
-            except Exception as e:
-                logMsg = f'Connect to broker failed: {str(e)}, Retry in {str(retryInterval)} seconds.'
-                logger.error(logMsg)
-                time.sleep(retryInterval)
-                if (nTry == 12):
-                    retryInterval = 60
+        """create a client for each broker and start each one connecting
+        on its own network thread, without waiting for the connections.
+        paho keeps trying to connect, and reconnects when a connection
+        drops, waiting from 1 to 60 seconds between attempts; meanwhile
+        the other brokers carry the traffic."""
+        for broker, port in self.mq_brokers:
+            client = self.create_mqtt_client(len(self.pool))
+            self.pool.add(broker, port, client)
+            logger.info(f'MQTT broker {broker}:{port} topic {self.mq_topic}')
+        self.publisher.attach(self.pool)
+        for conn in self.pool:
+            conn.client.reconnect_delay_set(1, 60)
+            conn.client.connect_async(conn.broker, conn.port)
+            conn.client.loop_start()
 
 
     def on_connect(self, mqClient, userdata, flags, reason_code, properties):
-        """The callback for when the client receives a CONNACK response from the broker."""
+        """The callback for when a client receives a CONNACK response from
+        its broker. the first connection up takes the subscription, and
+        messages waiting in the publisher are sent."""
         global logger
-        logger.info(f'Connect to broker: {str(reason_code)}')
+        conn = self.pool.connection(mqClient)
+        logger.info(f'Connect to broker {conn.name}: {str(reason_code)}')
+        if reason_code.is_failure:
+            return
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        self.mqClient.subscribe(self.mq_topic)
+        if self.pool.mark_connected(conn):
+            mqClient.subscribe(self.mq_topic)
+            logger.info(f'Subscribed to {self.mq_topic} on {conn.name}')
         self.mqtt_connected = True
+        self.notify()
 
 
     def on_disconnect(self, mqClient, userdata, flags, reason_code, properties):
-        """The callback for when the broker disconnects."""
+        """The callback for when a broker disconnects. if its connection
+        carried the subscription, another connected broker takes it over."""
         global logger
-        self.mqtt_connected = False
-        logger.warning(f'Broker disconnect!')
-        time.sleep(1)
+        conn = self.pool.connection(mqClient)
+        self.publisher.connection_lost(conn)
+        takeover = self.pool.mark_disconnected(conn)
+        self.mqtt_connected = self.pool.is_connected()
+        logger.warning(f'Broker disconnect {conn.name}!')
+        if takeover is not None:
+            takeover.client.subscribe(self.mq_topic)
+            logger.info(f'Subscribed to {self.mq_topic} on {takeover.name}')
 
 
     def on_message(self, mqClient, userdata, msg):
         """The callback for when a PUBLISH message is received from the
         broker. Messages from remotes have 4 or 5 space-delimited fields:
             hostname status serial hh:mm:ss rssi
-        the time stamp and rssi fields are not used by this program,
-        but are logged for informational purposes.
+        the time stamp field is not used by this program, but is logged
+        for informational purposes. the rssi field, when present, is kept
+        with the round trip time estimates for the remote. when running
+        as a worker, messages from remotes owned by other workers are
+        ignored.
         only the ack, ack_manual and pong messages include serial, as
         these are responses to messages sent from this program.
         ack: state change message received and state set.
@@ -212,114 +551,394 @@ class Controller:
         global logger
         try:
             msgText = msg.payload.decode('utf-8')
-            logger.debug(f'Received {msgText}')
             # unpack the fields, space-delimited
             msg = msgText.split()
             hostname = msg[0]
+            if hostname in self.others or \
+                    (hostname not in self.fleet and not self.owns(hostname)):
+                return
+            logger.debug('Received %s', msgText)
             status = msg[1]
             serial = msg[2]
+            now = time.monotonic()
+            # (signal strength is kept only for remotes in the fleet)
+            if len(msg) > 4 and hostname in self.fleet:
+                try:
+                    self.retries.observe(hostname, rssi=int(msg[4]))
+                except ValueError:
+                    pass
             if status in ['ack', 'ack_manual']:
-                if serial in self.retry:
-                    del self.retry[serial]
+                self.metrics.received.inc(status)
+                item = self.retries.ack(hostname, serial, now)
+                if item is None:
+                    logger.warning('Received ack for %s, not in flight.', serial)
                 else:
-                    logger.warning(f'Received ack for {serial}, not in retry dict.')
+                    self.journal.ack(hostname, item.sched)
             elif status in ['pong', 'connected', 'automatic_mode', \
                             'manual_mode', 'manual_on', 'manual_off']:
-                # if this remote is in the offline list, remove it
-                if hostname in self.offline:
-                    while hostname in self.offline:
-                        self.offline.remove(hostname)
-                    logger.info(f'{hostname} is online.')
-                    # also remove any items in the retry dictionary for this remote
-                    remove_list = []    # a list of dictionary items to remove
-                    for retry_serial, v in self.retry.items():
-                        retry_hostname = v[1]
-                        if hostname == retry_hostname:
-                            remove_list.append(serial)
-                    for s in remove_list:
-                        del self.retry[s]
+                self.metrics.received.inc(status)
+                if status == 'pong':
+                    self.retries.pong(hostname, serial, now)
+                # if this remote is offline, mark it online
+                if self.fleet.mark_online(hostname):
+                    logger.info('%s is online.', hostname)
+                    # also remove any retries for this remote
+                    self.retries.cancel_host(hostname)
+                    self.journal.mark_online(hostname)
+                    self.journal.cancel(hostname)
                 # if this remote came back online or returned to automatic
-                # mode, process the remotes; ensure we send state to this
-                # remote by clearing last_sched.
+                # mode, queue it to be processed.
                 if status in ['pong', 'connected', 'automatic_mode']:
-                    for r in self.remotes:
-                        if r.name == hostname:
-                            r.last_sched = []
-                    self.process()
+                    self.queue_remote(hostname)
             else:
+                self.metrics.received.inc('unknown')
                 logger.warning(f'Unknown message, ignored: {msgText}')
         except Exception as e:
             logger.error(f'Message receive fail: {str(e)}')
             return
 
 
-    def process(self):
-        """process all the remotes by checking their schedules and sending
-        new state if a new schedule is in effect.
-        each time we send a message to a remote, we place it in the retry
-        dictionary, including a retry count. it will be removed from
-        the retry dictionary upon receipt of an ack."""
-        retry = 2
-        for r in self.remotes:
-            if r.enabled:
-                if r.name in self.offline:
-                    # send a ping but do not add to the retry dict
-                    hex_serial = f'{random.randrange(pow(2,32)):08x}'
-                    self.mqClient.publish(r.name, f'Ping {hex_serial}')
-                    logger.debug(f'Ping {r.name} {hex_serial}')
-                else:
-                    sched = r.process()
-                    if sched:
-                        # tag each publish with a random serial number of 8 hex digits
-                        # add the publish information to the retry dict as:
-                        #   hex_serial: [retries_left, hostname, sched_list]
-                        hex_serial = f'{random.randrange(pow(2,32)):08x}'
-                        self.retry[hex_serial] = [retry, r.name, sched]
-                        self.mqClient.publish(r.name, f'{sched[1]} {hex_serial}')
-                        hhmm = sched[0] % 10000
-                        day = self.days[int(sched[0] / 10000)]
-                        logger.debug(f'Publish {r.name} {hhmm} {day} {sched[1]} {hex_serial}')
-
-
-    def process_retries(self):
-        """process the retry dictionary. resend any items that have
-        remaining retries. items that are out of retries are removed
-        from the retry dictionary and added to the offline list."""
-
-        # as we process the retry dictionary items, we build this list of
-        # dictionary items to be removed, i.e. those that are out of retries.
-        remove_list = []
-
-        for serial, v in self.retry.items():
-            hostname = v[1]
-            sched = v[2]
-            if v[0] > 0:
-                self.mqClient.publish(hostname, f'{sched[1]} {serial}')
-                hhmm = sched[0] % 10000
-                day = self.days[int(sched[0] / 10000)]
-                logger.debug(f'Retry {hostname} {hhmm} {day} {sched[1]} {serial}')
-                v[0] -= 1
+    def queue_remote(self, hostname):
+        """queue a remote to be processed after the coalescing window.
+        a remote that is queued several times is processed once."""
+        with self.pending_lock:
+            if not self.pending:
+                self.pending_deadline = time.monotonic() + COALESCE_SECONDS
+                wake = True
             else:
-                logger.warning(f'Retries exhausted for {serial} {v}')
-                remove_list.append(serial)
-
-        # now we can remove the exhausted dictionary items and put
-        # those remotes in the offline list.
-        # (a dictionary cannot change size during iteration)
-        for k in remove_list:
-            hostname = self.retry[k][1]
-            del self.retry[k]
-            if hostname not in self.offline:
-                self.offline.append(hostname)
-            logger.warning(f'{hostname} is not responding.')
+                wake = False
+            self.pending.add(hostname)
+        if wake:
+            self.notify()
+
+
+    def process_pending(self):
+        """process the queued remotes. ensure we send state to each one by
+        clearing last_sched, and reschedule it."""
+        with self.pending_lock:
+            pending, self.pending = self.pending, set()
+        now = time.time()
+        for hostname in pending:
+            r = self.fleet.get(hostname)
+            if r is None:
+                logger.warning(f'Status from unknown remote {hostname}, ignored.')
+            elif r.enabled:
+                r.last_sched = []
+                self.process_remote(r)
+                self.scheduler.schedule(r, now)
+
+
+    def tick(self):
+        """do whatever work is due: a requested reload of the config file,
+        the daily rollover of randomized schedules at midnight, retries that
+        are due, offline pings once a minute, the remotes whose transitions
+        are due, the remotes queued by status messages, and messages waiting
+        to be published. after a rollover, the next day's randomized
+        schedules are prepared last. if the wall clock was stepped or the
+        offset from UTC changed, every remote is processed and
+        rescheduled."""
+        if self.planned_wake is not None:
+            late = time.monotonic() - self.planned_wake
+            if late >= 0:
+                self.metrics.wakeup_lateness.observe(late)
+            self.planned_wake = None
+        # not rounded: the rollover must not run in the last moments of
+        # the day, as it reschedules the randomized remotes from now, past
+        # their transitions at midnight, which are not yet due.
+        t = time.localtime()
+        if self.reload_requested:
+            self.reload_requested = False
+            self.init_controller()
+        # time for the daily rollover? (to use the next day's random times)
+        if t.tm_mday != self.last_mday:
+            self.last_mday = t.tm_mday
+            # transitions due at midnight are dispatched first, from the
+            # weekly schedules in effect, which cover today as well. the
+            # rollover reschedules the randomized remotes from now, and
+            # would otherwise skip them.
+            self.process_due()
+            self.rollover(datetime.date(t.tm_year, t.tm_mon, t.tm_mday))
+        if self.check_clock():
+            self.metrics.clock_steps.inc()
+            self.next_ping = 0
+            self.process()
+        now = time.time()
+        mono = time.monotonic()
+        self.process_retries(mono)
+        if now + 0.5 >= self.next_ping:
+            self.next_ping = scheduler.transition_time(60, now)
+            self.ping_offline()
+        self.process_due()
+        if self.pending and mono >= self.pending_deadline:
+            self.process_pending()
+        self.publisher.flush()
+        self.journal.flush_if_due(time.monotonic())
+        if self.prepare_pending:
+            self.prepare_pending = False
+            tomorrow = self.rollover_date + datetime.timedelta(days=1)
+            for r in self.fleet:
+                if r.random:
+                    r.prepare(tomorrow)
+
+
+    def check_clock(self):
+        """return True if the wall clock was stepped since the last call,
+        or the local time's offset from UTC changed, e.g. at the start or
+        end of daylight saving time. the transitions in the scheduler are
+        then at the wrong epoch times, or some were skipped."""
+        wall, mono = time.time(), time.monotonic()
+        offset = time.localtime(wall).tm_gmtoff
+        changed = False
+        if self.last_clocks is not None:
+            step = (wall - self.last_clocks[0]) - (mono - self.last_clocks[1])
+            if abs(step) > CLOCK_JUMP_SECONDS:
+                logger.warning(f'Wall clock stepped by {step:+.1f} seconds, rescheduling all remotes.')
+                changed = True
+        if offset != self.utc_offset:
+            logger.info(f'UTC offset changed from {self.utc_offset / 3600:+g} '
+                        f'to {offset / 3600:+g} hours, rescheduling all remotes.')
+            changed = True
+        self.last_clocks = (wall, mono)
+        self.utc_offset = offset
+        return changed
+
+
+    def rollover(self, date):
+        """switch the randomized remotes to the weekly schedule starting
+        with date, which was prepared the day before, and reschedule them.
+        the schedules starting the day after are prepared by the next
+        tick()."""
+        logger.debug(f'Starting daily schedule rollover.')
+        logger.info(f'Dispatch lateness: {self.scheduler.stats.summary()}')
+        self.scheduler.stats.reset()
+        self.rollover_date = date
+        now = time.time()
+        for r in self.fleet:
+            if r.random:
+                r.rollover(date)
+                if r.enabled:
+                    self.scheduler.schedule(r, now)
+        self.prepare_pending = True
+        logger.debug(f'Rollover complete.')
 
 
-    def sleep_minute(self):
-        """Sleep until the minute rolls over."""
-        n = datetime.datetime.now()
-        sleep_until = datetime.datetime(n.year, n.month, n.day, n.hour, n.minute, 0, 0) \
-                + datetime.timedelta(minutes=1)
-        time.sleep((sleep_until - n).total_seconds())
+    def process(self):
+        """process all the remotes by checking their schedules and sending
+        new state if a new schedule is in effect, then schedule each
+        enabled remote at the time of its next transition."""
+        start = time.perf_counter()
+        now = time.time()
+        remotes = list(self.fleet.enabled())
+        self.process_batch(remotes)
+        for r in remotes:
+            self.scheduler.schedule(r, now)
+        self.metrics.sweep_seconds.observe(time.perf_counter() - start)
+
+
+    def process_due(self):
+        """process only the remotes whose next transition has come due,
+        and reschedule them. they are processed as at the latest time they
+        can be due, as the scheduler takes a transition a moment away to be
+        due already."""
+        now = time.time()
+        due = self.scheduler.pop_due(now)
+        if not due:
+            return
+        start = time.perf_counter()
+        late = self.scheduler.last_lateness
+        if late is not None and late > LATE_WARNING_SECONDS:
+            logger.warning(f'Transitions dispatched up to {late:.1f} seconds late.')
+        at = now + scheduler.DUE_TOLERANCE
+        self.process_batch((r for r in due if not self.fleet.is_offline(r.name)),
+                           remote.now_sow(at))
+        for r in due:
+            self.scheduler.schedule(r, at)
+        self.metrics.sweep_seconds.observe(time.perf_counter() - start)
+
+
+    def process_batch(self, remotes, sow=None):
+        """process the remotes in the iterable remotes at second of week
+        sow (default now) as process_remote() does, except that when every
+        remote in a group is due for the same state, one message is sent
+        to the group topic instead of one to each remote. the remotes in a
+        group still ack individually, and retries go to each remote's own
+        topic."""
+        grouped = {}
+        for r in remotes:
+            if r.group is None or self.fleet.is_offline(r.name):
+                self.process_remote(r, sow)
+                continue
+            sched = r.process(sow)
+            if sched:
+                grouped.setdefault((r.group, sched[1]), []).append((r, sched))
+        for (group, state), sends in grouped.items():
+            if len(sends) > 1 and len(sends) == len(self.fleet.group_members(group)):
+                self.publish_sched(group, sends)
+            else:
+                for s in sends:
+                    self.publish_sched(s[0].name, [s])
+
+
+    def process_remote(self, r, sow=None):
+        """check the schedule for a single remote at second of week sow
+        (default now) and send new state if a new schedule is in effect.
+        if the remote is offline, ping it instead. each time we send a
+        message to a remote, we add it to the retries, to be resent until
+        we receive an ack."""
+        if self.fleet.is_offline(r.name):
+            # send a ping but do not add to the retries
+            hex_serial = f'{random.randrange(pow(2,32)):08x}'
+            self.retries.ping_sent(r.name, hex_serial, time.monotonic())
+            self.publisher.publish(r.name, f'Ping {hex_serial}', key=self.route_key(r))
+            self.metrics.publishes.inc('ping')
+            logger.debug('Ping %s %s', r.name, hex_serial)
+        else:
+            sched = r.process(sow)
+            if sched:
+                self.publish_sched(r.name, [(r, sched)])
+
+
+    def publish_sched(self, topic, sends):
+        """publish a new state to topic, for the (remote, sched) pairs in
+        sends, which all have the same state. topic is the hostname of a
+        single remote, or the group topic of several."""
+        # tag each publish with a random serial number of 8 hex digits
+        hex_serial = f'{random.randrange(pow(2,32)):08x}'
+        now = time.monotonic()
+        for r, sched in sends:
+            self.retries.add(r.name, hex_serial, sched, now)
+            self.journal.sent(r.name, hex_serial, sched)
+        state = sends[0][1][1]
+        self.publisher.publish(topic, f'{state} {hex_serial}',
+                               [r.name for r, sched in sends], hex_serial, now,
+                               self.route_key(sends[0][0]))
+        self.metrics.publishes.inc('state' if len(sends) == 1 else 'group')
+        if len(sends) == 1:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Publish %s %s %s %s', topic,
+                             remote.format_dhhmmss(sends[0][1][0]), state, hex_serial)
+        else:
+            logger.debug('Publish %s %s %s to %d remotes', topic, state, hex_serial, len(sends))
+
+
+    def route_key(self, r):
+        """return the key that picks the broker for messages to remote r:
+        its group topic if it is in a group, so that the messages to the
+        group and to each remote in it keep their order, else None, for
+        the message's topic, which is the remote's own."""
+        if r is None or r.group is None:
+            return None
+        return r.group
+
+
+    def ping_offline(self):
+        """ping the enabled remotes that are offline."""
+        for r in self.fleet.offline_remotes():
+            self.process_remote(r)
+
+
+    def process_retries(self, now=None):
+        """resend any schedules that are due for a retry. a schedule whose
+        last publish is still waiting to leave our socket is not sent again.
+        remotes that are out of retries are marked offline, unless the
+        schedule never reached the broker. a schedule still queued, e.g.
+        while no broker is connected, starts its retries over; others are
+        sent again from scratch. now is the monotonic time."""
+        if now is None:
+            now = time.monotonic()
+        resend, exhausted = self.retries.expire(now)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for item in resend:
+            sched = item.sched
+            status = self.publisher.status(item.hostname, item.serial)
+            if status in (publisher.QUEUED, publisher.SENT):
+                self.metrics.retries_skipped.inc()
+                if debug:
+                    logger.debug('Retry %s %s %s %s skipped, publish %s', item.hostname,
+                                 remote.format_dhhmmss(sched[0]), sched[1], item.serial, status)
+                continue
+            self.publisher.publish(item.hostname, f'{sched[1]} {item.serial}',
+                                   [item.hostname], item.serial, now,
+                                   self.route_key(self.fleet.get(item.hostname)))
+            self.metrics.publishes.inc('retry')
+            if debug:
+                logger.debug('Retry %s %s %s %s', item.hostname,
+                             remote.format_dhhmmss(sched[0]), sched[1], item.serial)
+
+        for item in exhausted:
+            self.metrics.retries_exhausted.inc()
+            status = self.publisher.status(item.hostname, item.serial)
+            if status == publisher.QUEUED:
+                self.retries.add(item.hostname, item.serial, item.sched, now)
+                continue
+            if status in (publisher.SENT, publisher.FAILED):
+                logger.warning('Schedule %s for %s not delivered to the broker (%s), will resend.',
+                               item.serial, item.hostname, status)
+                self.retries.cancel_host(item.hostname)
+                self.journal.cancel(item.hostname)
+                self.queue_remote(item.hostname)
+                continue
+            logger.warning('Retries exhausted for %s %s %s', item.serial, item.hostname, item.sched)
+            self.retries.cancel_host(item.hostname)
+            self.fleet.mark_offline(item.hostname)
+            self.journal.mark_offline(item.hostname)
+            logger.warning('%s is not responding.', item.hostname)
+
+
+    def sleep_time(self):
+        """return the number of seconds until the next thing to do. on the
+        wall clock: the next remote transition, the next minute while
+        there are remotes offline, and midnight for the daily rollover. on
+        the monotonic clock: the next retry, the end of the coalescing
+        window for queued remotes, the next message that can be published,
+        and the journal flush. each pass of the main loop works out the
+        sleep afresh from these deadlines, so the time taken by the work
+        does not accumulate as drift."""
+        now = time.time()
+        n = datetime.datetime.fromtimestamp(now)
+        midnight = datetime.datetime(n.year, n.month, n.day) + datetime.timedelta(days=1)
+        wake = midnight.timestamp()
+        due = self.scheduler.next_due()
+        if due is not None:
+            wake = min(wake, due)
+        if self.fleet.offline:
+            wake = min(wake, self.next_ping)
+        sleep = wake - now
+
+        mono = time.monotonic()
+        wake = mono + MAX_SLEEP_SECONDS
+        due = self.retries.next_deadline()
+        if due is not None:
+            wake = min(wake, due)
+        due = self.journal.next_flush()
+        if due is not None:
+            wake = min(wake, due)
+        if self.pending:
+            wake = min(wake, self.pending_deadline)
+        due = self.publisher.next_send()
+        if due is not None:
+            wake = min(wake, due)
+        return max(0, min(sleep, wake - mono))
+
+
+    def sleep_until_due(self):
+        """sleep until the next thing to do, or until notify() is called."""
+        timeout = self.sleep_time()
+        self.planned_wake = time.monotonic() + timeout
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+
+    def request_reload(self):
+        """ask the main loop to reload the config file. used from the
+        SIGHUP handler, so that the reload cannot interrupt other work."""
+        self.reload_requested = True
+        self.notify()
+
+
+    def notify(self):
+        """wake the main loop early."""
+        self.wakeup.set()
 
 
     def write_pidfile(self):
@@ -329,6 +948,13 @@ class Controller:
                 p.write(f'{str(os.getpid())}\n')
 
 
+    def shutdown(self):
+        """write anything buffered in the journal and remove the pid file.
+        call when the program is terminating."""
+        self.journal.flush()
+        self.remove_pidfile()
+
+
     def remove_pidfile(self):
         """remove the pid file. call when the program is terminating."""
         if not self.args.syntax:
@@ -0,0 +1,80 @@
+class Fleet:
+    """The remotes managed by the controller, keyed on hostname in the
+    order they appear in the config file, and the set of hostnames that
+    are offline. lookups and offline/online changes take constant time.
+    the hostnames of the remotes in each group are kept too."""
+
+    def __init__(self):
+        self.remotes = {}
+        self.offline = set()
+        self.groups = {}
+
+
+    def __len__(self):
+        return len(self.remotes)
+
+
+    def __iter__(self):
+        return iter(self.remotes.values())
+
+
+    def __contains__(self, hostname):
+        return hostname in self.remotes
+
+
+    def get(self, hostname):
+        """return the Remote for hostname, or None."""
+        return self.remotes.get(hostname)
+
+
+    def update(self, remotes):
+        """replace the remotes with those in the iterable remotes, keeping
+        the offline status of hostnames that remain. returns a list of the
+        Remotes that were removed."""
+        new = {r.name: r for r in remotes}
+        removed = [r for name, r in self.remotes.items() if name not in new]
+        self.remotes = new
+        self.offline &= new.keys()
+        self.groups = {}
+        for r in new.values():
+            if r.group is not None:
+                self.groups.setdefault(r.group, set()).add(r.name)
+        return removed
+
+
+    def enabled(self):
+        """iterate over the enabled remotes."""
+        return (r for r in self.remotes.values() if r.enabled)
+
+
+    def is_offline(self, hostname):
+        return hostname in self.offline
+
+
+    def mark_offline(self, hostname):
+        """mark hostname offline. returns True if it was online."""
+        if hostname in self.offline:
+            return False
+        self.offline.add(hostname)
+        return True
+
+
+    def mark_online(self, hostname):
+        """mark hostname online. returns True if it was offline."""
+        if hostname not in self.offline:
+            return False
+        self.offline.remove(hostname)
+        return True
+
+
+    def group_members(self, group):
+        """return the set of hostnames of the remotes in group."""
+        return self.groups.get(group, set())
+
+
+    def offline_remotes(self):
+        """iterate over the enabled remotes that are offline."""
+        for hostname in list(self.offline):
+            r = self.remotes.get(hostname)
+            if r is not None and r.enabled:
+                yield r
@@ -0,0 +1,127 @@
+import remote
+
+# numpy is optional. without it, FleetMatrix is not available and the
+# syntax check prints the weekly schedule for each remote instead.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+W = remote.SECONDS_PER_WEEK
+
+
+def parse_when(text):
+    """convert a time given as 'day hh:mm[:ss]', e.g. 'sat 23:00', to
+    second of week. raises ValueError if it is not in that form."""
+    try:
+        day, hhmmss = text.lower().split()
+        d = remote.DAYS.index(day[:3])
+        hhmmss = remote.parse_time(hhmmss)
+    except ValueError:
+        raise ValueError(f'expected day hh:mm[:ss], got {text!r}')
+    return remote.dhhmmss_to_sow(d * 1000000 + hhmmss)
+
+
+def format_sow(sow):
+    """format a second of week as 'day hh:mm[:ss]'."""
+    return remote.format_dhhmmss(remote.sow_to_dhhmmss(sow))
+
+
+class FleetMatrix:
+    """The compiled weekly schedules of a set of remotes as one transition
+    table in numpy arrays, so the state of every remote at a given second
+    of week, or every transition in a time range, is found with a few
+    vectorized operations instead of asking each remote in turn.
+    states are stored as small integer codes indexing self.state_values;
+    -1 means a remote has no schedule items."""
+
+    def __init__(self, remotes):
+        if np is None:
+            raise RuntimeError('numpy is required for FleetMatrix')
+        remotes = list(remotes)
+        self.names = [r.name for r in remotes]
+        self.enabled = np.array([r.enabled for r in remotes], dtype=bool)
+        self.state_values = []
+        codes = {}
+        owner, second, code = [], [], []
+        for i, r in enumerate(remotes):
+            for t, item in zip(r.compiled.seconds, r.compiled.items):
+                c = codes.get(item[1])
+                if c is None:
+                    c = codes[item[1]] = len(self.state_values)
+                    self.state_values.append(item[1])
+                owner.append(i)
+                second.append(t)
+                code.append(c)
+        n = len(remotes)
+        # each remote's items are already in time order, so sorting by
+        # owner keeps them in order within each remote.
+        self.owner = np.array(owner, dtype=np.int64)
+        self.second = np.array(second, dtype=np.int64)
+        self.code = np.array(code, dtype=np.int8)
+        self.key = self.owner * W + self.second
+        # the range of transition indexes for each remote
+        self.start = np.searchsorted(self.owner, np.arange(n), 'left')
+        self.end = np.searchsorted(self.owner, np.arange(n), 'right')
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def states_at(self, sow):
+        """return an array of the state code of each remote at second of
+        week sow."""
+        n = len(self.names)
+        if not len(self.key):
+            return np.full(n, -1, dtype=np.int8)
+        idx = np.searchsorted(self.key, np.arange(n) * W + sow % W, 'right') - 1
+        # before a remote's first item, its last item (from the previous
+        # week) is in effect.
+        idx = np.where(idx < self.start, self.end - 1, idx)
+        states = self.code[np.clip(idx, 0, len(self.code) - 1)]
+        return np.where(self.end > self.start, states, -1).astype(np.int8)
+
+
+    def transitions_between(self, start, end):
+        """return a list of (sow, name, state) for every schedule item
+        taking effect from second of week start up to but not including
+        end, in time order. the range may wrap past the end of the week."""
+        start %= W
+        end %= W
+        if start <= end:
+            mask = (self.second >= start) & (self.second < end)
+        else:
+            mask = (self.second >= start) | (self.second < end)
+        idx = np.flatnonzero(mask)
+        order = np.argsort((self.second[idx] - start) % W, kind='stable')
+        return [(int(self.second[i]), self.names[self.owner[i]],
+                 self.state_values[self.code[i]]) for i in idx[order]]
+
+
+    def print_timeline(self):
+        """print each time of the week when any enabled remote changes
+        state, with the number of remotes changing and the number of
+        enabled remotes in each state after the change. the counts are
+        updated from each time's transitions rather than recomputed."""
+        idx = np.flatnonzero(self.enabled[self.owner]) if len(self.owner) else []
+        print(f'\nFleet timeline: {int(np.count_nonzero(self.enabled))} enabled remotes')
+        if not len(idx):
+            return
+        idx = idx[np.argsort(self.second[idx], kind='stable')]
+        secs = self.second[idx]
+        groups = np.split(idx, np.flatnonzero(np.diff(secs)) + 1)
+        k = len(self.state_values) + 1     # state codes shifted by one for -1
+        current = self.states_at(int(secs[0]) - 1).astype(np.int64)
+        counts = np.bincount(current[self.enabled] + 1, minlength=k)
+        for g in groups:
+            # if a remote has two items at the same time, the last one wins
+            own = self.owner[g][::-1]
+            own, first = np.unique(own, return_index=True)
+            new = self.code[g][::-1][first].astype(np.int64)
+            counts -= np.bincount(current[own] + 1, minlength=k)
+            counts += np.bincount(new + 1, minlength=k)
+            current[own] = new
+            text = '  '.join(f'{v}: {int(counts[c + 1])}'
+                             for c, v in enumerate(self.state_values))
+            print(f'{format_sow(int(self.second[g[0]])):12}  {len(own):6d} changing  {text}')
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('timer_main')
+
+# after a failed write, the journal is written again after this many
+# seconds, doubling up to JOURNAL_RETRY_MAX.
+JOURNAL_RETRY_MIN = 5
+JOURNAL_RETRY_MAX = 300
+
+class Journal:
+    """An append-only file recording, for each remote, the last schedule
+    it acknowledged, the schedule in flight to it and whether it is
+    offline, so that a restarted controller can carry on where it left
+    off instead of sending state to every remote.
+    records are one JSON object per line, buffered in memory and written
+    with a single fsync at most every flush_interval seconds. when the
+    file grows past compact_size bytes it is rewritten as a snapshot.
+    if the file cannot be written, the buffered records are dropped and
+    only the state is kept, and the whole state is written as a snapshot
+    at the next attempt, backing off between failures.
+    the methods take a lock, as acks arrive on the mqtt network thread."""
+
+    def __init__(self):
+        self.filename = None        # None when the journal is disabled
+        self.flush_interval = 10.0
+        self.compact_size = 1000000
+        # the state the file describes
+        self.acked = {}     # hostname: sched
+        self.inflight = {}  # hostname: [serial, sched]
+        self.offline = set()
+        # records not yet written, and the time they must be written by
+        self.buffer = []
+        self.flush_deadline = None
+        # whether the last write failed, and the wait before the next one
+        self.failed = False
+        self.retry_delay = JOURNAL_RETRY_MIN
+        self.lock = threading.RLock()
+
+
+    def configure(self, filename, flush_interval=10, compact_size=1000000):
+        """set the journal file, or None to disable the journal.
+        raises ValueError for invalid values."""
+        if flush_interval < 0 or compact_size <= 0:
+            raise ValueError('journal: invalid flush_interval or compact_size')
+        with self.lock:
+            if filename != self.filename:
+                self.flush()
+                if self.failed:
+                    # try the new file straight away
+                    self.retry_delay = JOURNAL_RETRY_MIN
+                    self.flush_deadline = time.monotonic()
+            self.filename = filename
+            self.flush_interval = float(flush_interval)
+            self.compact_size = int(compact_size)
+
+
+    def load(self):
+        """read the journal file, if there is one. a partly written last
+        line, as left by a crash, is ignored."""
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        n = 0
+        with self.lock, open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    logger.warning(f'Journal {self.filename}: ignored bad record.')
+                    continue
+                self.apply(rec)
+                n += 1
+        logger.info(f'Journal {self.filename}: {n} records, {len(self.acked)} acked, '
+                    f'{len(self.inflight)} in flight, {len(self.offline)} offline.')
+
+
+    def apply(self, rec):
+        """update the state from a record."""
+        t = rec['t']
+        h = rec['h']
+        if t == 'sent':
+            self.inflight[h] = [rec['n'], tuple(rec['s'])]
+        elif t == 'ack':
+            self.acked[h] = tuple(rec['s'])
+            if h in self.inflight and self.inflight[h][1] == self.acked[h]:
+                del self.inflight[h]
+        elif t == 'cancel':
+            self.inflight.pop(h, None)
+        elif t == 'off':
+            self.offline.add(h)
+            self.inflight.pop(h, None)
+        elif t == 'on':
+            self.offline.discard(h)
+        elif t == 'drop':
+            self.acked.pop(h, None)
+            self.inflight.pop(h, None)
+            self.offline.discard(h)
+
+
+    def record(self, rec):
+        """apply a record and buffer it to be written."""
+        if self.filename is None:
+            return
+        with self.lock:
+            self.apply(rec)
+            if self.failed:
+                # the next attempt writes the whole state
+                return
+            self.buffer.append(json.dumps(rec, separators=(',', ':')))
+            if self.flush_deadline is None:
+                self.flush_deadline = time.monotonic() + self.flush_interval
+
+
+    # one method for each type of record
+
+    def sent(self, hostname, serial, sched):
+        self.record({'t': 'sent', 'h': hostname, 'n': serial, 's': list(sched)})
+
+
+    def ack(self, hostname, sched):
+        self.record({'t': 'ack', 'h': hostname, 's': list(sched)})
+
+
+    def cancel(self, hostname):
+        if hostname in self.inflight:
+            self.record({'t': 'cancel', 'h': hostname})
+
+
+    def mark_offline(self, hostname):
+        self.record({'t': 'off', 'h': hostname})
+
+
+    def mark_online(self, hostname):
+        self.record({'t': 'on', 'h': hostname})
+
+
+    def drop(self, hostname):
+        self.record({'t': 'drop', 'h': hostname})
+
+
+    def next_flush(self):
+        """return the monotonic time when buffered records must be written,
+        or None."""
+        return self.flush_deadline
+
+
+    def flush_if_due(self, now):
+        if self.flush_deadline is not None and now >= self.flush_deadline:
+            self.flush()
+
+
+    def flush(self):
+        """write the buffered records with one fsync, then compact the
+        file if it has grown too large. after a failed write, the state is
+        written as a snapshot instead."""
+        with self.lock:
+            if self.filename is None or not (self.buffer or self.failed):
+                self.buffer = []
+                self.flush_deadline = None
+                return
+            try:
+                if self.failed:
+                    self.compact()
+                    size = 0
+                else:
+                    with open(self.filename, 'a') as f:
+                        f.write('\n'.join(self.buffer) + '\n')
+                        f.flush()
+                        os.fsync(f.fileno())
+                        size = f.tell()
+            except OSError as e:
+                self.write_failed(e)
+                return
+            if self.failed:
+                logger.info(f'Journal {self.filename} written again.')
+            self.buffer = []
+            self.flush_deadline = None
+            self.failed = False
+            self.retry_delay = JOURNAL_RETRY_MIN
+            if size > self.compact_size:
+                try:
+                    self.compact()
+                except OSError as e:
+                    logger.error(f'Journal compact failed: {str(e)}')
+
+
+    def write_failed(self, e):
+        """drop the buffered records, which are already in the state, and
+        try again after a delay that doubles with each failure."""
+        if self.failed:
+            logger.debug(f'Journal write failed again: {str(e)}')
+        else:
+            logger.error(f'Journal write failed: {str(e)}. Retrying in '
+                         f'{self.retry_delay} seconds, backing off to {JOURNAL_RETRY_MAX}.')
+        self.failed = True
+        self.buffer = []
+        self.flush_deadline = time.monotonic() + self.retry_delay
+        self.retry_delay = min(self.retry_delay * 2, JOURNAL_RETRY_MAX)
+
+
+    def compact(self):
+        """rewrite the file as a snapshot of the current state, replacing
+        it atomically. raises OSError if it cannot be written."""
+        tmp = f'{self.filename}.tmp'
+        with open(tmp, 'w') as f:
+            for h in self.offline:
+                f.write(json.dumps({'t': 'off', 'h': h}) + '\n')
+            for h, sched in self.acked.items():
+                f.write(json.dumps({'t': 'ack', 'h': h, 's': list(sched)}) + '\n')
+            for h, (serial, sched) in self.inflight.items():
+                f.write(json.dumps({'t': 'sent', 'h': h, 'n': serial, 's': list(sched)}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+        logger.debug(f'Journal {self.filename} compacted.')
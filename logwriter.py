@@ -0,0 +1,196 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO,
+          'warning': logging.WARNING, 'error': logging.ERROR}
+
+
+class BatchedFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """A TimedRotatingFileHandler that, while batched is set, leaves each
+    record in the file's buffer instead of flushing it, so that the
+    LogWriter thread can write a batch of records to the file at once."""
+
+    def __init__(self, *args, **kwargs):
+        self.batched = False
+        super().__init__(*args, **kwargs)
+
+
+    def flush(self):
+        if not self.batched:
+            super().flush()
+
+
+    def flush_batch(self):
+        """write the buffered records to the file."""
+        logging.handlers.TimedRotatingFileHandler.flush(self)
+
+
+    def close(self):
+        self.flush_batch()
+        super().close()
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that puts records on the queue as they are, so the
+    message is merged with its arguments and formatted on the LogWriter
+    thread rather than the caller's. the arguments of a log call must not
+    be changed after the call."""
+
+    def prepare(self, record):
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats a record as one line of JSON: the epoch time, the level,
+    the message and its arguments, which are kept apart so that each field
+    of an event can be read back without parsing the text."""
+
+    def format(self, record):
+        rec = {'t': round(record.created, 3), 'l': record.levelname, 'm': record.msg}
+        if record.args:
+            rec['a'] = record.args
+        if record.exc_info:
+            rec['x'] = self.formatException(record.exc_info)
+        return json.dumps(rec, separators=(',', ':'), default=str)
+
+
+class LogWriter:
+    """The handlers for the program's logger: the log file, rotated at
+    midnight keeping a week of logs, and an optional event log of JSON
+    lines. in the background mode, log calls only put the record on a
+    queue, and a thread formats and writes the records, flushing them to
+    the files once flush_interval seconds after the first of a batch, or
+    straight away for a warning or worse. logging then adds no file I/O
+    to the mqtt callbacks or the main loop. otherwise each record is
+    written and flushed by the caller, as by a plain file handler."""
+
+    def __init__(self, logger, log_filename):
+        self.logger = logger
+        self.formatter = logging.Formatter(
+                fmt='%(asctime)s.%(msecs)03d\t%(levelname)s\t%(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S')
+        self.file_handler = BatchedFileHandler(log_filename, when='midnight', backupCount=7)
+        self.file_handler.setFormatter(self.formatter)
+        self.event_handler = None
+        self.event_filename = None
+        self.handlers = (self.file_handler,)
+        self.flush_interval = 1.0
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = DeferredQueueHandler(self.queue)
+        self.thread = None
+        # held by the thread while it writes, and while the handlers change
+        self.lock = threading.Lock()
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(self.file_handler)
+        atexit.register(self.stop)
+
+
+    def configure(self, level='debug', background=True, flush_interval=1,
+                  event_log=None):
+        """set the logging level, whether records are written by the
+        background thread, how long it may hold records before flushing
+        them, and the file name of the event log (None for no event log).
+        raises ValueError for an invalid value."""
+        if str(level).lower() not in LEVELS:
+            raise ValueError(f'logging level must be one of {", ".join(LEVELS)}, not {level}')
+        if flush_interval < 0:
+            raise ValueError('logging flush_interval must not be negative')
+        self.logger.setLevel(LEVELS[str(level).lower()])
+        self.flush_interval = flush_interval
+        if event_log != self.event_filename:
+            with self.lock:
+                if self.event_handler is not None:
+                    self.remove_handler(self.event_handler)
+                    self.event_handler.close()
+                    self.event_handler = None
+                self.event_filename = event_log
+                if event_log is not None:
+                    self.event_handler = BatchedFileHandler(
+                            event_log, when='midnight', backupCount=7)
+                    self.event_handler.setFormatter(JsonLinesFormatter())
+                    self.event_handler.batched = self.thread is not None
+                    if self.thread is None:
+                        self.logger.addHandler(self.event_handler)
+                handlers = [self.file_handler]
+                if self.event_handler is not None:
+                    handlers.append(self.event_handler)
+                self.handlers = tuple(handlers)
+        if background:
+            self.start()
+        else:
+            self.stop()
+
+
+    def remove_handler(self, handler):
+        if handler in self.logger.handlers:
+            self.logger.removeHandler(handler)
+
+
+    def start(self):
+        """switch to writing the log from the background thread."""
+        if self.thread is not None:
+            return
+        with self.lock:
+            for h in self.handlers:
+                h.batched = True
+                self.remove_handler(h)
+            self.logger.addHandler(self.queue_handler)
+        self.thread = threading.Thread(target=self.run, name='log writer', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """write whatever is queued, stop the background thread, and go
+        back to writing the log from the caller's thread. called at exit."""
+        if self.thread is None:
+            return
+        with self.lock:
+            self.remove_handler(self.queue_handler)
+            for h in self.handlers:
+                self.logger.addHandler(h)
+        self.queue.put(None)
+        self.thread.join(5)
+        self.thread = None
+        with self.lock:
+            for h in self.handlers:
+                h.batched = False
+                h.flush_batch()
+
+
+    def flush(self):
+        for h in self.handlers:
+            h.flush_batch()
+
+
+    def run(self):
+        """the background thread: write records from the queue, and flush
+        them once the oldest unflushed one has waited flush_interval
+        seconds, or at once for a warning or worse."""
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                with self.lock:
+                    self.flush()
+                deadline = None
+                continue
+            if record is None:
+                break
+            with self.lock:
+                for h in self.handlers:
+                    if record.levelno >= h.level:
+                        h.handle(record)
+                if record.levelno >= logging.WARNING or not self.flush_interval:
+                    self.flush()
+                    deadline = None
+                elif deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+        with self.lock:
+            self.flush()
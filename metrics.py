@@ -0,0 +1,220 @@
+import logging
+import math
+import threading
+
+logger = logging.getLogger('timer_main')
+
+# upper bounds in seconds of the buckets of the timing histograms
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+def format_value(v):
+    if v == math.inf:
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def escape_label(v):
+    """escape a label value as the Prometheus text format requires."""
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{escape_label(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Counter:
+    """A count that only goes up, optionally one for each combination of
+    label values."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=(), lock=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # a counter without labels is shown as zero before it is counted
+        self.values = {} if self.labels else {(): 0}
+        self.lock = lock or threading.Lock()
+
+
+    def inc(self, *labels, n=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+
+    def samples(self):
+        for labels, v in sorted(self.values.items()):
+            yield self.name, format_labels(self.labels, labels), v
+
+
+class Gauge:
+    """A value that goes up and down. it is either set, or read when the
+    metrics are rendered from the function given as read."""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, read=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.value = 0
+
+
+    def set(self, value):
+        self.value = value
+
+
+    def samples(self):
+        yield self.name, '', self.read() if self.read is not None else self.value
+
+
+class Histogram:
+    """Counts of observed values in buckets with the given upper bounds,
+    with their sum, as in the Prometheus histogram type."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS, lock=None):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets) + (math.inf,)
+        self.counts = [0] * len(self.bounds)
+        self.sum = 0.0
+        self.lock = lock or threading.Lock()
+
+
+    def observe(self, value):
+        with self.lock:
+            self.sum += value
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+
+    def samples(self):
+        total = 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            yield f'{self.name}_bucket', format_labels(('le',), (format_value(bound),)), total
+        yield f'{self.name}_sum', '', self.sum
+        yield f'{self.name}_count', '', total
+
+
+class Metrics:
+    """The controller's metrics, and a small HTTP server that serves them
+    in the Prometheus text format. the metrics are always kept, as that
+    costs little; the server runs only when enabled in the config file."""
+
+    def __init__(self, prefix='timer_main'):
+        self.prefix = prefix
+        self.metrics = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.address = None
+
+        self.received = self.counter('messages_received_total',
+            'Messages received from the remotes, by status, or unknown for any other status.', ('status',))
+        self.publishes = self.counter('publishes_total',
+            'Messages published, by kind: state for one remote, group, retry or ping.', ('kind',))
+        self.retries_exhausted = self.counter('retries_exhausted_total',
+            'Schedules whose retries ran out.')
+        self.retries_skipped = self.counter('retries_skipped_total',
+            'Retries not sent because the last publish had not left our socket.')
+        self.clock_steps = self.counter('clock_steps_total',
+            'Steps of the wall clock and changes of UTC offset.')
+        self.sweep_seconds = self.histogram('sweep_seconds',
+            'Time taken to process the remotes that are due, or all of them.')
+        self.reload_seconds = self.histogram('reload_seconds',
+            'Time taken to read the config file and apply it.')
+        self.dispatch_lateness = self.histogram('dispatch_lateness_seconds',
+            'How late each schedule transition was dispatched.')
+        self.wakeup_lateness = self.histogram('wakeup_lateness_seconds',
+            'How late the main loop woke from a timed sleep.')
+
+
+    def counter(self, name, help, labels=()):
+        m = Counter(f'{self.prefix}_{name}', help, labels, self.lock)
+        self.metrics.append(m)
+        return m
+
+
+    def gauge(self, name, help, read=None):
+        m = Gauge(f'{self.prefix}_{name}', help, read)
+        self.metrics.append(m)
+        return m
+
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        m = Histogram(f'{self.prefix}_{name}', help, buckets, self.lock)
+        self.metrics.append(m)
+        return m
+
+
+    def render(self):
+        """return the metrics in the Prometheus text format."""
+        lines = []
+        for m in self.metrics:
+            # gauges are read without our lock, as reading them may take
+            # the lock of the object they measure.
+            if m.type == 'gauge':
+                samples = list(m.samples())
+            else:
+                with self.lock:
+                    samples = list(m.samples())
+            lines.append(f'# HELP {m.name} {m.help}')
+            lines.append(f'# TYPE {m.name} {m.type}')
+            for name, labels, v in samples:
+                lines.append(f'{name}{labels} {format_value(v)}')
+        return '\n'.join(lines) + '\n'
+
+
+    def serve(self, address, port):
+        """serve the metrics at http://address:port/metrics from a daemon
+        thread, replacing the server for a different address. a port of
+        None stops the server."""
+        if self.server is not None and self.address == (address, port):
+            return
+        self.stop()
+        if port is None:
+            return
+        import http.server
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        except OSError as e:
+            logger.error(f'Metrics server on {address}:{port} failed: {str(e)}')
+            return
+        self.server.daemon_threads = True
+        self.address = (address, port)
+        threading.Thread(target=self.server.serve_forever, name='metrics',
+                         daemon=True).start()
+        logger.info(f'Serving metrics on http://{address}:{port}/metrics')
+
+
+    def stop(self):
+        """stop the metrics server, if it is running."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            self.address = None
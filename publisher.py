@@ -0,0 +1,230 @@
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger('timer_main')
+
+# the delivery status of the last message published to a remote
+QUEUED = 'queued'           # waiting for its turn to be handed to paho
+SENT = 'sent'               # handed to paho, not yet written to the socket
+DELIVERED = 'delivered'     # written to the socket (qos 0) or acknowledged
+                            # by the broker (qos 1 and 2)
+FAILED = 'failed'           # paho refused it, or dropped it on a disconnect
+
+
+class Message:
+    """A message waiting to be published, or handed to paho. hostnames
+    are the remotes it is for, serial the serial number it carries, or
+    None for messages that are not tracked (pings), and key the key that
+    picks the broker it is published on."""
+
+    __slots__ = ('topic', 'payload', 'hostnames', 'serial', 'key', 'conn',
+                 'info', 'generation', 'superseded')
+
+    def __init__(self, topic, payload, hostnames, serial, key):
+        self.topic = topic
+        self.payload = payload
+        self.hostnames = hostnames
+        self.serial = serial
+        self.key = key
+        self.conn = None        # the pool Connection it was handed to,
+        self.info = None        # and paho's MQTTMessageInfo for it
+        self.generation = 0     # its connection's generation when handed over
+        self.superseded = False
+
+
+class Publisher:
+    """Publishes messages for the controller through a BrokerPool.
+    messages are queued and handed to paho at up to rate messages per
+    second, in bursts of up to burst messages, with at most window
+    messages handed to paho and not yet published. the messages with the
+    same key go through the same broker while it is connected. a rate or window of
+    zero means no limit. messages are held in the queue while there is
+    no connection to a broker, and sent on whichever connects first.
+    untracked messages (pings) are dropped instead.
+    the MQTTMessageInfo for the last message published to each remote is
+    kept, so that a retry can tell a message that never left our socket
+    from one the remote did not acknowledge."""
+
+    def __init__(self):
+        self.pool = None
+        self.qos = 0
+        self.rate = 0
+        self.burst = 100
+        self.window = 0
+        self.tokens = 0
+        self.last_refill = 0
+        self.lost = False       # set when a connection is lost
+        # paho's MQTT_ERR_AGAIN, MQTT_ERR_SUCCESS and MQTT_ERR_NO_CONN, so
+        # that paho is not imported until the client is created.
+        self.ok_codes = (-1, 0)
+        self.no_conn = 4
+        self.queue = collections.deque()
+        # messages handed to paho and not yet published, keyed on
+        # (client, mid), as each client numbers its messages separately.
+        self.outstanding = {}
+        # (client, mid) from on_publish. it is called with paho's locks held, so it
+        # only appends here, and they are removed from outstanding
+        # under our lock by flush().
+        self.completed = collections.deque()
+        # the last tracked Message published to each hostname
+        self.latest = {}
+        # called from on_publish when there are messages waiting for the
+        # window to open, to wake the main loop.
+        self.on_ready = None
+        self.lock = threading.RLock()
+
+
+    def configure(self, qos=0, rate=0, burst=100, window=0):
+        """set the qos for published messages and the limits on how fast
+        they are handed to paho. raises ValueError for invalid values."""
+        if qos not in (0, 1, 2):
+            raise ValueError(f'qos must be 0, 1 or 2, not {qos}')
+        if rate < 0 or window < 0:
+            raise ValueError('publish rate and window must not be negative')
+        if burst < 1:
+            raise ValueError('publish burst must be at least 1')
+        with self.lock:
+            self.qos = qos
+            self.rate = rate
+            self.burst = burst
+            self.window = int(window)
+            self.tokens = min(self.tokens, burst) if self.last_refill else burst
+
+
+    def attach(self, pool):
+        """publish through the given BrokerPool, and receive the publish
+        callbacks of its clients."""
+        self.pool = pool
+        for conn in pool:
+            conn.client.on_publish = self.on_publish
+
+
+    def connected(self):
+        """return True if there is a connection to a broker."""
+        return self.pool is not None and self.pool.is_connected()
+
+
+    def connection_lost(self, conn):
+        """called from the disconnect callback for the pool Connection
+        conn. paho discards qos 0 messages it has not written to the
+        socket when the connection drops, so those handed to it are no
+        longer expected to be published. messages on the other
+        connections are unaffected."""
+        conn.generation += 1
+        self.lost = True
+
+
+    def publish(self, topic, payload, hostnames=(), serial=None, now=None, key=None):
+        """queue a message for the remotes in hostnames, and send what the
+        limits allow. key (default topic) picks the broker. if serial is
+        given, the message is tracked as the last one published to each
+        of the remotes. a tracked message for a single remote supersedes
+        one still in the queue for it."""
+        if serial is None and not self.connected():
+            return
+        m = Message(topic, payload, tuple(hostnames), serial,
+                    topic if key is None else key)
+        with self.lock:
+            if serial is not None:
+                for hostname in m.hostnames:
+                    old = self.latest.get(hostname)
+                    if old is not None and old.info is None and len(old.hostnames) == 1:
+                        old.superseded = True
+                    self.latest[hostname] = m
+            self.queue.append(m)
+            self.flush(now)
+
+
+    def flush(self, now=None):
+        """hand queued messages to paho, as far as the limits allow.
+        now is the monotonic time."""
+        with self.lock:
+            while self.completed:
+                self.outstanding.pop(self.completed.popleft(), None)
+            if self.lost:
+                self.lost = False
+                if self.qos == 0:
+                    # qos 0 messages from a lost connection are not coming back
+                    for key in [key for key, m in self.outstanding.items()
+                                if m.generation != m.conn.generation]:
+                        del self.outstanding[key]
+            if not self.queue or not self.connected():
+                return
+            if now is None:
+                now = time.monotonic()
+            if self.rate:
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            while self.queue:
+                if self.queue[0].superseded:
+                    self.queue.popleft()
+                    continue
+                if self.rate and self.tokens < 1:
+                    break
+                if self.window and len(self.outstanding) >= self.window:
+                    break
+                m = self.queue.popleft()
+                m.conn, m.info = self.pool.publish(m.topic, m.payload, self.qos, m.key)
+                m.generation = m.conn.generation
+                if self.rate:
+                    self.tokens -= 1
+                if m.info.rc in self.ok_codes and not m.info.is_published():
+                    self.outstanding[(m.conn.client, m.info.mid)] = m
+            if self.queue:
+                logger.debug('Publish queue: %d waiting, %d outstanding',
+                             len(self.queue), len(self.outstanding))
+
+
+    def next_send(self):
+        """return the monotonic time when the next queued message can be sent,
+        or None if there is none, or it is waiting for a connection or for
+        the window to open (on_publish wakes the main loop for that)."""
+        with self.lock:
+            if not self.queue or not self.connected():
+                return None
+            if self.window and len(self.outstanding) - len(self.completed) >= self.window:
+                return None
+            if not self.rate or self.tokens >= 1:
+                return time.monotonic()
+            return self.last_refill + (1 - self.tokens) / self.rate
+
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        """The callback for when paho has written a qos 0 message to the
+        socket, or the broker has acknowledged a qos 1 or 2 message."""
+        self.completed.append((client, mid))
+        if self.queue and self.window and self.on_ready is not None:
+            self.on_ready()
+
+
+    def status(self, hostname, serial):
+        """return the delivery status of the message with the given serial
+        published to hostname, or None if it is not the last one tracked."""
+        with self.lock:
+            m = self.latest.get(hostname)
+            if m is None or m.serial != serial:
+                return None
+            if m.info is None:
+                return QUEUED
+            rc = m.info.rc
+            if rc in self.ok_codes or (rc == self.no_conn and self.qos > 0):
+                if m.info.is_published():
+                    return DELIVERED
+                if self.qos == 0 and m.generation != m.conn.generation:
+                    return FAILED
+                return SENT
+            return FAILED
+
+
+    def forget(self, hostname):
+        """stop tracking messages published to hostname."""
+        with self.lock:
+            self.latest.pop(hostname, None)
+
+
+    def pending(self):
+        """return the number of messages waiting in the queue."""
+        return len(self.queue)
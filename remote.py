@@ -1,29 +1,255 @@
+import datetime
 import logging
 import random
 import time
+import weakref
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
 
 logger = logging.getLogger('timer_main')
 
+# schedule times are expressed as dhhmmss, the day of the week (mon=0)
+# times 1000000 plus the time of day, and are compiled to seconds since
+# monday 00:00:00 (second of week)
+SECONDS_PER_DAY = 24 * 60 * 60
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# the number of days of randomized schedule items each remote keeps cached
+DAY_CACHE_SIZE = 14
+
+
+def parse_time(t):
+    """convert a time from the sched block of the config file to hhmmss.
+    the time is an integer hhmm, or a string "hh:mm" or "hh:mm:ss", which
+    the config file's loader reads whether or not it is quoted.
+    raises ValueError if it is not a valid time."""
+    try:
+        if isinstance(t, bool):
+            raise ValueError
+        if isinstance(t, int):
+            hour, minute = divmod(t, 100)
+            second = 0
+        else:
+            fields = [int(f) for f in t.split(':')]
+            if len(fields) not in (2, 3):
+                raise ValueError
+            hour, minute, second = (fields + [0])[:3]
+        if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+            raise ValueError
+    except (ValueError, AttributeError):
+        raise ValueError(f'invalid schedule time {t!r}, expected hhmm or hh:mm:ss')
+    return hour * 10000 + minute * 100 + second
+
+
+def format_time(hhmmss):
+    """format a time of day expressed as hhmmss as hh:mm, or hh:mm:ss if
+    the seconds are not zero."""
+    hour, mmss = divmod(hhmmss, 10000)
+    minute, second = divmod(mmss, 100)
+    if second:
+        return f'{hour:02d}:{minute:02d}:{second:02d}'
+    return f'{hour:02d}:{minute:02d}'
+
+
+def format_dhhmmss(t):
+    """format a schedule time expressed as dhhmmss as day hh:mm[:ss]."""
+    d, hhmmss = divmod(t, 1000000)
+    return f'{DAYS[d]} {format_time(hhmmss)}'
+
+
+def dhhmmss_to_sow(t):
+    """convert a schedule time expressed as dhhmmss to second of week."""
+    d, hhmmss = divmod(t, 1000000)
+    hour, mmss = divmod(hhmmss, 10000)
+    minute, second = divmod(mmss, 100)
+    return d * SECONDS_PER_DAY + hour * 3600 + minute * 60 + second
+
+
+def sow_to_dhhmmss(sow):
+    """convert a second of week to a schedule time expressed as dhhmmss."""
+    d, seconds = divmod(sow % SECONDS_PER_WEEK, SECONDS_PER_DAY)
+    hour, seconds = divmod(seconds, 3600)
+    minute, second = divmod(seconds, 60)
+    return d * 1000000 + hour * 10000 + minute * 100 + second
+
+
+def now_sow(t=None):
+    """return the current local time (or epoch time t) as second of week.
+    the second is the one that has started, not the nearest, so that a
+    transition is never taken to be in effect before its time."""
+    if t is None:
+        t = time.time()
+    local = time.localtime(t)
+    return (local.tm_wday * SECONDS_PER_DAY + local.tm_hour * 3600
+            + local.tm_min * 60 + local.tm_sec)
+
+
+class WeekSchedule:
+    """A compiled weekly schedule. the (dhhmmss, state) items are kept in
+    ascending time order, with a parallel array of second of week offsets
+    that is searched with bisect, so queries take logarithmic time and
+    return the existing items without allocating new ones."""
+
+    __slots__ = ('items', 'seconds', '__weakref__')
+
+    def __init__(self, week_sched):
+        self.items = tuple(sorted(tuple(s) for s in week_sched))
+        self.seconds = array('l', (dhhmmss_to_sow(s[0]) for s in self.items))
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def index(self, sow):
+        """return the index of the item in effect at second of week sow.
+        if sow is before the earliest item, the latest item (from the
+        previous week) is in effect; an index of -1 gives us that."""
+        return bisect_right(self.seconds, sow) - 1
+
+
+    def current(self, sow):
+        """return the (dhhmmss, state) item in effect at second of week
+        sow, or None if the schedule is empty."""
+        if self.items:
+            return self.items[self.index(sow)]
+        return None
+
+
+    def prev_transition(self, sow):
+        """return the second of week of the item in effect at sow,
+        or None if the schedule is empty."""
+        if self.items:
+            return self.seconds[self.index(sow)]
+        return None
+
+
+    def next_transition(self, sow):
+        """return the second of week of the next item after sow,
+        or None if the schedule is empty."""
+        if self.items:
+            i = bisect_right(self.seconds, sow)
+            return self.seconds[i if i < len(self.seconds) else 0]
+        return None
+
+
+    def seconds_until_next(self, sow):
+        """return the number of seconds from sow until the next item
+        takes effect, from 1 to SECONDS_PER_WEEK, or None if the schedule
+        is empty. with a single item, the next transition is a week away."""
+        nxt = self.next_transition(sow)
+        if nxt is None:
+            return None
+        return (nxt - sow - 1) % SECONDS_PER_WEEK + 1
+
+
+class Template:
+    """The parts of a compiled schedule that depend only on the sched
+    block from the config file. remotes with identical sched blocks share
+    one Template, which is interned by template()."""
+
+    __slots__ = ('sched', 'day_items', 'week', '__weakref__')
+
+    def __init__(self, sched):
+        """sched is a normalized tuple of (time, state, days) tuples."""
+        self.sched = sched
+        # the (hhmmss, state) items for each day of the week (mon=0),
+        # in the order they appear in sched
+        self.day_items = tuple(tuple((s[0], s[1]) for s in sched if day in s[2])
+                               for day in DAYS)
+        # the weekly schedule without randomization, times as dhhmmss
+        self.week = WeekSchedule((d * 1000000 + hhmmss, state)
+                                 for d, items in enumerate(self.day_items)
+                                 for hhmmss, state in items)
+
+
+# the Templates in use, keyed on the normalized sched tuple and on the sched
+# block as it appears in the config file. entries disappear when no remote
+# refers to the Template any more.
+_templates = weakref.WeakValueDictionary()
+_raw_templates = weakref.WeakValueDictionary()
+
+
+def template(raw_sched):
+    """return the shared Template for a sched block from the config file,
+    a list of [time, state, days] lists. the block is normalized to a tuple
+    of (time, state, days) tuples in reverse time order, with the time as
+    hhmmss and the days field lower case and its special values expanded.
+    raises an exception if the block is not structured as expected."""
+    raw = tuple(tuple(s) for s in raw_sched)
+    t = _raw_templates.get(raw)
+    if t is not None:
+        return t
+    sched = []
+    for s in sorted(((parse_time(s[0]),) + s[1:] for s in raw),
+                    reverse=True, key=lambda t: t[0]):
+        days = s[2].lower()
+        if 'all' in days:
+            days = days.replace('all', 'sun mon tue wed thu fri sat')
+        if 'weekdays' in days:
+            days = days.replace('weekdays', 'mon tue wed thu fri')
+        if 'weekends' in days:
+            days = days.replace('weekends', 'sat sun')
+        sched.append((s[0], s[1], days))
+    sched = tuple(sched)
+    t = _templates.get(sched)
+    if t is None:
+        t = _templates[sched] = Template(sched)
+    _raw_templates[raw] = t
+    return t
+
+
+def normalize(props):
+    """given the props dictionary for a remote from the config file, return
+    a tuple (enabled, random, sched, group) where sched is the normalized
+    sched tuple from the remote's Template and group is the group topic or
+    None. the tuple is hashable, so it can be compared to tell whether a
+    remote's config has changed.
+    raises an exception if props is not structured as expected."""
+    enabled = props.get('enabled', True)
+    rand = props.get('random', 0)
+    group = props.get('group')
+    return (enabled, rand, template(props['sched']).sched,
+            None if group is None else str(group))
+
+
 class Remote:
     """A single remote unit with a schedule."""
 
-    def __init__(self, name, props):
-        """props is a dictionary with keys sched, random and enabled.
-        random and enabled are optional. sched is a list of lists giving
-        the schedule for the remote. each sub-list is [time, state, days].
-        we build self.sched and then use it to build the weekly
-        schedule, self.week_sched. we keep self.sched just to print
-        as part of the syntax check command line option."""
+    __slots__ = ('name', 'enabled', 'random', 'sched', 'group', 'error_msg',
+                 'last_sched', 'template', 'compiled', 'key', 'seed', 'date',
+                 'day_cache', 'next_compiled', 'next_date')
+
+    def __init__(self, name, props, seed=0, date=None):
+        """props is a dictionary with keys sched, random, enabled and group.
+        random, enabled and group are optional. group is a topic that the
+        remote subscribes to along with the other remotes in the group.
+        sched is a list of lists giving the schedule for the remote.
+        each sub-list is [time, state, days], where time is an integer
+        hhmm or a string "hh:mm" or "hh:mm:ss".
+        the sched block is compiled into a Template that is shared with
+        any other remotes with the same block. self.sched is the block as
+        a tuple of (time, state, days) tuples; we keep it just to print as
+        part of the syntax check command line option. self.key is the
+        normalized config, used to tell whether the config for this remote
+        changed on a reload.
+        without a random factor, the weekly schedule self.compiled is the
+        shared one from the Template. with a random factor, it covers the
+        seven days starting with date (default today), built from the
+        Template and a vector of offsets in seconds for each date. the offsets
+        come from a generator seeded with seed, the remote name and the
+        date, so they are reproducible."""
 
-        self.days = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
         # the config file can pass syntax checking but be structured in ways
         # that we do not expect. if so, we pass error information back
         # in the object, which then needs to be checked by the caller.
         try:
             self.name = name
-            self.enabled = props.get('enabled', True)
-            self.random = props.get('random', 0)
-            self.sched = sorted(props['sched'], reverse=True, key=lambda t: t[0])
+            self.template = template(props['sched'])
+            self.key = normalize(props)
+            self.enabled, self.random, self.sched, self.group = self.key
         except Exception as e:
             logger.error(f'Unexpected structure in config file: {str(e)}')
             self.name = 'error'
@@ -34,81 +260,131 @@ class Remote:
         # new state was sent to the remote, i.e. the last call to process()
         self.last_sched = []
 
-        # make the days field lower case and expand special values
-        for s in self.sched:
-            s[2] = s[2].lower()
-            if 'all' in s[2]:
-                s[2] = s[2].replace('all', 'sun mon tue wed thu fri sat')
-            if 'weekdays' in s[2]:
-                s[2] = s[2].replace('weekdays', 'mon tue wed thu fri')
-            if 'weekends' in s[2]:
-                s[2] = s[2].replace('weekends', 'sat sun')
-
-        # create the weekly schedule, store times as dhhmm
-        self.week_sched = []
-        for d, day in enumerate(self.days):
-            for s in self.sched:
-                if day in s[2]:
-                    sched_time = d * 10000 + s[0]
-                    if self.random != 0:
-                        sched_time = self.randomize(sched_time)
-                    self.week_sched.append([sched_time, s[1]])
-        self.week_sched.sort(reverse=True)
-
-
-    def randomize(self, t):
-        """given the schedule time t expressed as dhhmm, return a
-        randomly adjusted time by applying the random value for this remote.
-        if this would push the time into the next day, then set it to 2359
-        instead. if it would push it back into the previous day,
-        then set it to 0000."""
-
-        # save the day of the week, and convert the time to minutes
-        d = t // 10000
-        hhmm = t - d * 10000
-        hour = hhmm // 100
-        minute = hhmm - hour * 100
+        # random offsets by date, least recently used first, and the
+        # weekly schedule for the day after self.date, once prepared.
+        self.seed = seed
+        self.date = None
+        self.day_cache = OrderedDict()
+        self.next_compiled = None
+        self.next_date = None
+
+        # the weekly schedule, times as dhhmmss
+        if self.random != 0:
+            self.rollover(date or datetime.date.today())
+        else:
+            self.compiled = self.template.week
+
+
+    def day_offsets(self, date):
+        """return an array of the random offsets in seconds for the items
+        of the Template for the given date's day of the week. the offsets
+        are cached, evicting the least recently used date when the cache
+        is full."""
+        offsets = self.day_cache.get(date)
+        if offsets is not None:
+            self.day_cache.move_to_end(date)
+            return offsets
+        d = date.weekday()
+        rng = random.Random(f'{self.seed}:{self.name}:{date.isoformat()}')
+        offsets = array('l')
+        for hhmmss, state in self.template.day_items[d]:
+            t = d * 1000000 + hhmmss
+            offsets.append(dhhmmss_to_sow(self.randomize(t, rng)) - dhhmmss_to_sow(t))
+        self.day_cache[date] = offsets
+        while len(self.day_cache) > DAY_CACHE_SIZE:
+            self.day_cache.popitem(last=False)
+        return offsets
+
+
+    def week_for(self, date):
+        """return the compiled weekly schedule for the seven days starting
+        with date. each day of the week appears once, so the dhhmmss times
+        are unique to a date."""
+        week_sched = []
+        for i in range(7):
+            day = date + datetime.timedelta(days=i)
+            d = day.weekday()
+            for (hhmmss, state), offset in zip(self.template.day_items[d],
+                                               self.day_offsets(day)):
+                t = dhhmmss_to_sow(d * 1000000 + hhmmss) + offset
+                week_sched.append((sow_to_dhhmmss(t), state))
+        return WeekSchedule(week_sched)
+
+
+    def prepare(self, date):
+        """build the weekly schedule starting with date ahead of time,
+        so that rollover() to that date only needs to swap it in."""
+        if self.random != 0 and self.next_date != date:
+            self.next_compiled = self.week_for(date)
+            self.next_date = date
+
+
+    def rollover(self, date):
+        """make the weekly schedule starting with date the one in effect.
+        does nothing for a remote without a random factor."""
+        if self.random == 0 or date == self.date:
+            return
+        if date == self.next_date:
+            self.compiled = self.next_compiled
+        else:
+            self.compiled = self.week_for(date)
+        self.date = date
+        self.next_compiled = None
+        self.next_date = None
+
+
+    def randomize(self, t, rng=random):
+        """given the schedule time t expressed as dhhmmss, return a
+        randomly adjusted time by applying the random value (in minutes)
+        for this remote. the seconds are kept as they are. if this would
+        push the time into the next day, then set it to 23:59 instead.
+        if it would push it back into the previous day, then set it to
+        00:00."""
+
+        # save the day of the week and the seconds, and convert the time
+        # to minutes
+        d, hhmmss = divmod(t, 1000000)
+        hour, mmss = divmod(hhmmss, 10000)
+        minute, second = divmod(mmss, 100)
         minutes = 60 * hour + minute
 
         # apply the random factor
-        minutes += random.randint(-self.random, self.random)
+        minutes += rng.randint(-self.random, self.random)
         # limit the randomized time to the current day
         if minutes < 0:
             minutes = 0
         elif minutes > 1439:
             minutes = 1439
-        return d * 10000 + 100 * (minutes // 60) + minutes % 60
-
-
-    def process(self):
-        """process schedules for a given remote. if the current schedule
-        is different from the last time we checked, then return the list
-        for the current schedule, else return an empty list."""
-
-        # calculate current time as an integer, dhhmm,
-        # where d is the day of the week (mon=0)
-        local = time.localtime(time.time() + 0.5)   # round up fractional seconds
-        now = local.tm_wday * 10000 + local.tm_hour * 100 + local.tm_min
-
-        # find the current schedule item in effect.
-        # if the current time is less than the earliest schedule, or greater
-        # than or equal to the latest schedule, then the latest schedule is in
-        # effect. remember, the schedules are sorted in reverse order.
-        if self.week_sched:     # it is possible that there are none
-            if now < self.week_sched[-1][0] or now >= self.week_sched[0][0]:
-                current_sched = self.week_sched[0]
-            # else, step through the schedule items to find which is in effect
-            else:
-                for s in self.week_sched:
-                    if now >= s[0]:
-                        current_sched = s
-                        break
-
-            if current_sched != self.last_sched:
-                self.last_sched = current_sched
-                return self.last_sched
-            else:
-                return []
+        return d * 1000000 + 10000 * (minutes // 60) + 100 * (minutes % 60) + second
+
+
+    def process(self, sow=None):
+        """process schedules for a given remote at second of week sow
+        (default now). if the current schedule is different from the last
+        time we checked, then return the list for the current schedule,
+        else return an empty list."""
+
+        # find the current schedule item in effect. it is possible that
+        # there are none.
+        if sow is None:
+            sow = now_sow()
+        current_sched = self.compiled.current(sow)
+        if current_sched is None:
+            return []
+        if current_sched != self.last_sched:
+            self.last_sched = current_sched
+            return self.last_sched
+        else:
+            return []
+
+
+    def next_transition(self, sow=None):
+        """return the number of seconds from sow (default now) until the
+        next schedule item for this remote takes effect, or None if there
+        are no schedule items."""
+        if sow is None:
+            sow = now_sow()
+        return self.compiled.seconds_until_next(sow)
 
 
     def print(self, verbose):
@@ -117,10 +393,14 @@ class Remote:
         print(f'\nRemote name: {self.name}')
         print(f'Enabled: {self.enabled}')
         print(f'Random factor: {self.random}')
+        if self.group is not None:
+            print(f'Group: {self.group}')
+        if self.random != 0:
+            print(f'Randomized from: {self.date.isoformat()} (seed {self.seed})')
         print('Schedule:')
         for s in sorted(self.sched):
-            print(s)
+            print([format_time(s[0]), s[1], s[2]])
         if verbose:
             print('Week schedule:')
-            for w in self.week_sched:
-                print(w)
+            for w in reversed(self.compiled.items):
+                print([format_dhhmmss(w[0]), w[1]])
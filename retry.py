@@ -0,0 +1,321 @@
+import logging
+import math
+import threading
+
+logger = logging.getLogger('timer_main')
+
+class RetryItem:
+    """A schedule that has been sent to a remote but not acknowledged."""
+
+    __slots__ = ('hostname', 'serial', 'sched', 'retries_left', 'attempts',
+                 'sent', 'tick', 'cancelled')
+
+    def __init__(self, hostname, serial, sched, retries_left, sent):
+        self.hostname = hostname
+        self.serial = serial
+        self.sched = sched
+        self.retries_left = retries_left
+        self.attempts = 0       # number of retries sent so far
+        self.sent = sent        # monotonic time of the first send
+        self.tick = 0           # timing wheel tick when the item is due
+        self.cancelled = False
+
+
+class RttEstimator:
+    """Smoothed round trip time and round trip time variance for one
+    remote, computed as for the TCP retransmission timeout (RFC 6298),
+    and the last signal strength the remote reported."""
+
+    __slots__ = ('srtt', 'rttvar', 'rssi')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rssi = None
+
+
+    def sample(self, rtt):
+        """update the estimates with a measured round trip time."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+
+    def rto(self, initial, minimum, maximum, granularity):
+        """return the retransmission timeout in seconds, or initial if
+        there have been no samples yet."""
+        if self.srtt is None:
+            return initial
+        rto = self.srtt + max(granularity, 4 * self.rttvar)
+        return min(max(rto, minimum), maximum)
+
+
+class TimingWheel:
+    """A hashed timing wheel holding RetryItems by deadline. time is
+    divided into ticks of the given resolution in seconds, and each tick
+    maps to one of a fixed number of slots. an item far in the future
+    shares a slot with nearer items and is skipped until its own tick
+    comes around. cancelled items are dropped when their slot is visited."""
+
+    def __init__(self, resolution=0.25, slots=512):
+        self.resolution = resolution
+        self.slots = slots
+        self.wheel = [[] for _ in range(slots)]
+        self.current = None     # the last tick that was expired
+        self.count = 0          # number of items, including cancelled ones
+
+
+    def to_tick(self, t):
+        """return the tick at or after the monotonic time t."""
+        return math.ceil(t / self.resolution)
+
+
+    def add(self, item, deadline):
+        """add an item that is due at the monotonic time deadline."""
+        item.tick = self.to_tick(deadline)
+        if self.current is not None and item.tick <= self.current:
+            item.tick = self.current + 1
+        self.wheel[item.tick % self.slots].append(item)
+        self.count += 1
+
+
+    def expire(self, now):
+        """remove and return a list of the items that are due at now."""
+        now_tick = math.floor(now / self.resolution)
+        if self.current is None:
+            self.current = now_tick - 1
+        if now_tick <= self.current:
+            return []
+        # visit each slot between the last tick and now, but each slot
+        # only once if we have fallen more than a revolution behind.
+        first = max(self.current + 1, now_tick - self.slots + 1)
+        due = []
+        for t in range(first, now_tick + 1):
+            slot = self.wheel[t % self.slots]
+            if slot:
+                keep = []
+                for item in slot:
+                    if item.cancelled:
+                        self.count -= 1
+                    elif item.tick <= now_tick:
+                        self.count -= 1
+                        due.append(item)
+                    else:
+                        keep.append(item)
+                slot[:] = keep
+        self.current = now_tick
+        return due
+
+
+    def next_deadline(self):
+        """return the monotonic time of the earliest item, or None."""
+        if not self.count:
+            return None
+        start = self.current if self.current is not None else 0
+        later = None
+        for k in range(1, self.slots + 1):
+            for item in self.wheel[(start + k) % self.slots]:
+                if item.cancelled:
+                    continue
+                if item.tick <= start + k:
+                    return item.tick * self.resolution
+                if later is None or item.tick < later:
+                    later = item.tick
+        return later * self.resolution if later is not None else None
+
+
+class RetryManager:
+    """Tracks schedules sent to remotes until they are acknowledged,
+    resending them with exponential backoff. items are indexed by
+    hostname and serial, so an ack or cancelling all of the items for a
+    host does not need to search. sending a new schedule to a remote
+    supersedes any in-flight items for a different schedule, and the
+    number of items in flight per host is capped.
+    the time to wait for an ack starts from each remote's own retransmission
+    timeout, estimated from the round trip times of its acks and pongs.
+    a remote is considered offline only when it is out of retries and
+    has not responded for offline_after seconds, or twice that if its
+    signal is weaker than weak_rssi. the methods take a lock, as acks
+    arrive on the mqtt network thread."""
+
+    def __init__(self, resolution=0.25, **policy):
+        self.configure(**policy)
+        self.wheel = TimingWheel(resolution)
+        # hostname: {serial: RetryItem}, in the order the items were sent
+        self.by_host = {}
+        self.count = 0
+        # hostname: RttEstimator
+        self.rtt = {}
+        # hostname: (serial, monotonic time) of the last ping sent
+        self.pings = {}
+        self.lock = threading.RLock()
+
+
+    def configure(self, retries=3, initial=5.0, factor=2.0, maximum=60.0,
+                  max_inflight=2, minimum=0.5, offline_after=60.0,
+                  weak_rssi=-80):
+        """set the retry policy. raises ValueError for invalid values."""
+        if retries < 0 or initial <= 0 or factor < 1 or minimum <= 0 \
+                or maximum < initial or maximum < minimum \
+                or max_inflight < 1 or offline_after < 0:
+            raise ValueError('retry: invalid retries, initial, factor, min, max, '
+                             'max_inflight or offline_after')
+        self.retries = int(retries)
+        self.initial = float(initial)
+        self.factor = float(factor)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.max_inflight = int(max_inflight)
+        self.offline_after = float(offline_after)
+        self.weak_rssi = weak_rssi
+
+
+    def __len__(self):
+        return self.count
+
+
+    def rto(self, hostname):
+        """return the retransmission timeout for hostname in seconds."""
+        est = self.rtt.get(hostname)
+        if est is None:
+            return self.initial
+        return est.rto(self.initial, self.minimum, self.maximum, self.wheel.resolution)
+
+
+    def delay(self, hostname, attempts):
+        """return the number of seconds to wait for an ack after the
+        given number of retries have been sent to hostname."""
+        return min(self.rto(hostname) * self.factor ** attempts, self.maximum)
+
+
+    def grace(self, hostname):
+        """return the number of seconds that hostname may go without
+        responding before it is considered offline."""
+        est = self.rtt.get(hostname)
+        if est is not None and est.rssi is not None and est.rssi < self.weak_rssi:
+            return 2 * self.offline_after
+        return self.offline_after
+
+
+    def observe(self, hostname, rtt=None, rssi=None):
+        """record a round trip time and/or signal strength for hostname."""
+        with self.lock:
+            est = self.rtt.get(hostname)
+            if est is None:
+                est = self.rtt[hostname] = RttEstimator()
+            if rtt is not None:
+                est.sample(rtt)
+            if rssi is not None:
+                est.rssi = rssi
+
+
+    def ping_sent(self, hostname, serial, now):
+        """record the time a ping was sent, to measure the pong."""
+        self.pings[hostname] = (serial, now)
+
+
+    def pong(self, hostname, serial, now):
+        """sample the round trip time of a pong."""
+        ping = self.pings.pop(hostname, None)
+        if ping is not None and ping[0] == serial:
+            self.observe(hostname, rtt=now - ping[1])
+
+
+    def add(self, hostname, serial, sched, now):
+        """track a schedule that has just been sent to a remote."""
+        with self.lock:
+            items = self.by_host.setdefault(hostname, {})
+            # a different schedule in flight for this remote is stale
+            for s in [s for s, item in items.items() if item.sched != sched]:
+                logger.debug('Superseded %s %s', hostname, s)
+                self.discard(items.pop(s))
+            # cap the number in flight, dropping the oldest
+            while len(items) >= self.max_inflight:
+                s = next(iter(items))
+                logger.debug('Dropped %s %s, too many in flight.', hostname, s)
+                self.discard(items.pop(s))
+            item = RetryItem(hostname, serial, sched, self.retries, now)
+            items[serial] = item
+            self.count += 1
+            self.wheel.add(item, now + self.delay(hostname, 0))
+            return item
+
+
+    def discard(self, item):
+        """mark an item that has been removed from by_host as cancelled."""
+        item.cancelled = True
+        self.count -= 1
+
+
+    def ack(self, hostname, serial, now):
+        """remove and return the item acknowledged by hostname, or None
+        if it is not in flight. other items in flight for the same
+        schedule are confirmed too, so they are also removed.
+        the round trip time is sampled only if the item was never resent,
+        as we cannot tell which send an ack to a resent item is for."""
+        with self.lock:
+            items = self.by_host.get(hostname)
+            if not items or serial not in items:
+                return None
+            item = items.pop(serial)
+            self.discard(item)
+            for s in [s for s, other in items.items() if other.sched == item.sched]:
+                self.discard(items.pop(s))
+            if not items:
+                del self.by_host[hostname]
+            if item.attempts == 0:
+                self.observe(hostname, rtt=now - item.sent)
+            return item
+
+
+    def cancel_host(self, hostname):
+        """remove all items in flight for hostname."""
+        with self.lock:
+            for item in self.by_host.pop(hostname, {}).values():
+                self.discard(item)
+
+
+    def forget(self, hostname):
+        """drop the round trip estimate and any ping in flight for a remote
+        that has left the fleet."""
+        with self.lock:
+            self.rtt.pop(hostname, None)
+            self.pings.pop(hostname, None)
+
+
+    def expire(self, now):
+        """return two lists of the items that have not been acknowledged
+        in time: those to be resent, which are rescheduled with backoff,
+        and those that are out of retries and past the offline grace
+        period, which are removed. an item that is out of retries but
+        still within the grace period is resent until the grace period ends."""
+        with self.lock:
+            resend = []
+            exhausted = []
+            for item in self.wheel.expire(now):
+                remaining = item.sent + self.grace(item.hostname) - now
+                if item.retries_left > 0 or remaining > 0:
+                    item.retries_left = max(item.retries_left - 1, 0)
+                    item.attempts += 1
+                    delay = self.delay(item.hostname, item.attempts)
+                    if item.retries_left == 0 and remaining > 0:
+                        delay = min(delay, remaining)
+                    self.wheel.add(item, now + delay)
+                    resend.append(item)
+                else:
+                    items = self.by_host[item.hostname]
+                    del items[item.serial]
+                    if not items:
+                        del self.by_host[item.hostname]
+                    self.count -= 1
+                    exhausted.append(item)
+            return resend, exhausted
+
+
+    def next_deadline(self):
+        """return the monotonic time when the next item is due, or None."""
+        with self.lock:
+            return self.wheel.next_deadline() if self.count else None
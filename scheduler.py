@@ -0,0 +1,161 @@
+import datetime
+import heapq
+import itertools
+import math
+import time
+
+import remote
+
+# upper bounds in seconds of the buckets of the dispatch lateness histogram
+LATENESS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, math.inf)
+
+# a transition this many seconds away is treated as due, as a timed wait
+# may return a little before its timeout.
+DUE_TOLERANCE = 0.002
+
+
+def transition_time(seconds, now=None):
+    """return the epoch time that is the given number of seconds of local
+    time after the start of the current second. the seconds are added to
+    the local time of day rather than to the epoch time, so that across a
+    change to or from daylight saving time a transition still happens at
+    its scheduled local time. a local time that is skipped when the clocks
+    go forward maps to the same time after the change."""
+    if now is None:
+        now = time.time()
+    second_start = math.floor(now)
+    target = datetime.datetime.fromtimestamp(second_start) + datetime.timedelta(seconds=seconds)
+    return time.mktime(target.timetuple())
+
+
+class DispatchStats:
+    """How late the remotes' transitions were dispatched compared with
+    their scheduled times: the count, mean and maximum, and a histogram
+    with the upper bounds in LATENESS_BUCKETS. each lateness is also
+    passed to the observe() method of histogram, if given, which is not
+    reset."""
+
+    def __init__(self, histogram=None):
+        self.histogram = histogram
+        self.reset()
+
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(LATENESS_BUCKETS)
+
+
+    def record(self, lateness):
+        """record the lateness in seconds of one dispatched transition."""
+        if self.histogram is not None:
+            self.histogram.observe(lateness)
+        self.count += 1
+        self.total += lateness
+        self.max = max(self.max, lateness)
+        for i, bound in enumerate(LATENESS_BUCKETS):
+            if lateness <= bound:
+                self.buckets[i] += 1
+                break
+
+
+    def summary(self):
+        """return the statistics as a line of text for the log."""
+        if not self.count:
+            return 'no transitions'
+        hist = ' '.join(f'<={b}s:{n}' for b, n in zip(LATENESS_BUCKETS, self.buckets)
+                        if n and b != math.inf)
+        if self.buckets[-1]:
+            hist += f' >{LATENESS_BUCKETS[-2]}s:{self.buckets[-1]}'
+        return (f'{self.count} transitions, mean {self.total / self.count * 1000:.1f} ms, '
+                f'max {self.max * 1000:.1f} ms, {hist}')
+
+
+class TransitionScheduler:
+    """A heap of remotes keyed on the epoch time of their next schedule
+    transition, so that the controller can sleep until the earliest one
+    and then process only the remotes that are due.
+    a remote is in the heap at most once; rescheduling it leaves a stale
+    heap entry behind, which is discarded when it reaches the top.
+    the lateness of the dispatched transitions is kept in stats, and
+    passed on to histogram, if given."""
+
+    def __init__(self, histogram=None):
+        # heap items are [due_time, seq, remote, timed]. seq breaks ties
+        # and identifies the current entry for each remote. timed is True
+        # for the time of a schedule transition, and False for a remote
+        # that was made due by schedule_now().
+        self.heap = []
+        # remote name: seq of the current heap entry
+        self.entries = {}
+        self.counter = itertools.count()
+        # the lateness of the dispatched transitions
+        self.stats = DispatchStats(histogram)
+        self.last_lateness = None
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def schedule(self, r, now=None):
+        """add or reschedule remote r at the time of its next transition.
+        remotes with no schedule items are removed."""
+        if now is None:
+            now = time.time()
+        seconds = r.next_transition(remote.now_sow(now))
+        if seconds is None:
+            self.remove(r)
+            return
+        seq = next(self.counter)
+        self.entries[r.name] = seq
+        heapq.heappush(self.heap, [transition_time(seconds, now), seq, r, True])
+
+
+    def schedule_now(self, r, now=None):
+        """add or reschedule remote r so that it is due immediately."""
+        if now is None:
+            now = time.time()
+        seq = next(self.counter)
+        self.entries[r.name] = seq
+        heapq.heappush(self.heap, [now, seq, r, False])
+
+
+    def remove(self, r):
+        """remove remote r from the scheduler, if present."""
+        self.entries.pop(r.name, None)
+
+
+    def discard_stale(self):
+        """pop heap entries that have been superseded or removed."""
+        while self.heap and self.entries.get(self.heap[0][2].name) != self.heap[0][1]:
+            heapq.heappop(self.heap)
+
+
+    def next_due(self):
+        """return the epoch time of the earliest transition, or None."""
+        self.discard_stale()
+        return self.heap[0][0] if self.heap else None
+
+
+    def pop_due(self, now=None):
+        """remove and return a list of the remotes whose transition time
+        is at or before now. the caller is expected to reschedule them.
+        the lateness of each transition is recorded in stats, and the
+        largest of them is kept in last_lateness (None if no transition
+        was due)."""
+        if now is None:
+            now = time.time()
+        due = []
+        self.last_lateness = None
+        while self.next_due() is not None and self.heap[0][0] <= now + DUE_TOLERANCE:
+            due_time, seq, r, timed = heapq.heappop(self.heap)
+            del self.entries[r.name]
+            due.append(r)
+            if timed:
+                lateness = now - due_time
+                self.stats.record(lateness)
+                if self.last_lateness is None or lateness > self.last_lateness:
+                    self.last_lateness = lateness
+        return due
@@ -0,0 +1,43 @@
+import hashlib
+import os
+
+
+def parse_shard(text):
+    """convert a shard given as "I/N" on the command line to a tuple
+    (index, workers), with index from 0 to workers - 1. for argparse."""
+    try:
+        index, workers = (int(s) for s in text.split('/'))
+    except ValueError:
+        raise ValueError(f'shard must be INDEX/WORKERS, not {text}')
+    if workers < 1 or not 0 <= index < workers:
+        raise ValueError(f'shard index must be from 0 to {workers - 1}')
+    return (index, workers)
+
+
+def weight(index, hostname):
+    """return the rendezvous hashing weight of hostname for a worker."""
+    h = hashlib.blake2b(f'{index}:{hostname}'.encode('utf-8'), digest_size=8)
+    return int.from_bytes(h.digest(), 'big')
+
+
+def owner(hostname, workers, group=None):
+    """return the index of the worker that owns hostname, the one with
+    the highest weight for it (rendezvous hashing). when the number of
+    workers changes from n to n + 1, only the hostnames that the new
+    worker wins move, about 1 / (n + 1) of them, and the rest keep their
+    owner. the remotes in a group are owned by the worker that owns the
+    group topic, so that one worker can send to the whole group."""
+    if workers == 1:
+        return 0
+    key = hostname if group is None else f'group:{group}'
+    return max(range(workers), key=lambda i: weight(i, key))
+
+
+def shard_filename(filename, shard):
+    """return filename with the shard index inserted before its extension,
+    so that each worker keeps its own file, or filename unchanged if
+    shard is None."""
+    if shard is None:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return f'{root}.{shard[0]}{ext}'
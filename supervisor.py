@@ -0,0 +1,139 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import controller
+
+logger = logging.getLogger('timer_main')
+
+class Supervisor:
+    """Runs the controller as several worker processes, each managing the
+    remotes that it owns by rendezvous hashing on the hostname (see
+    shard.py), with its own mqtt client, retries, offline status, and log,
+    pid and journal files. SIGHUP, SIGINT and SIGTERM are passed on to the
+    workers, and a worker that exits unexpectedly is restarted."""
+
+    def __init__(self, mainfile, args):
+        self.mainfile = os.path.realpath(mainfile)
+        self.args = args
+        self.workers = [None] * args.workers    # subprocess.Popen objects
+        self.started = [0] * args.workers       # epoch time each was started
+        self.restart_at = [0] * args.workers    # when to restart a dead one
+        self.backoff = [1] * args.workers
+        self.stopping = False
+        self.wakeup = threading.Event()
+
+        self.progpath = os.path.dirname(self.mainfile)
+        self.progname = os.path.basename(sys.argv[0]).split(sep='.')[0]
+        self.pid_filename = f'{self.progpath}{os.sep}{self.progname}.pid'
+
+        global logger
+        self.log_writer = controller.init_logging(
+            f'{self.progpath}{os.sep}{self.progname}.log', self.progname)
+        logger = self.log_writer.logger
+        logger.info(f'Start supervisor PID {str(os.getpid())} with {args.workers} workers')
+        with open(self.pid_filename, 'w') as p:
+            p.write(f'{str(os.getpid())}\n')
+
+
+    def worker_command(self, index):
+        """return the command line for a worker process."""
+        cmd = [sys.executable, self.mainfile, '--config', self.args.config,
+               '--shard', f'{index}/{len(self.workers)}']
+        if self.args.asyncio:
+            cmd.append('--asyncio')
+        return cmd
+
+
+    def start_worker(self, index):
+        """start a worker. workers run in their own session, so that a
+        signal meant for the supervisor, e.g. from the terminal, does not
+        reach them directly; the supervisor passes signals on itself."""
+        p = subprocess.Popen(self.worker_command(index), start_new_session=True)
+        self.workers[index] = p
+        self.started[index] = time.time()
+        logger.info(f'Started worker {index} PID {p.pid}')
+
+
+    def signal_workers(self, sig):
+        """send a signal to every running worker."""
+        for p in self.workers:
+            if p is not None and p.poll() is None:
+                try:
+                    p.send_signal(sig)
+                except ProcessLookupError:
+                    pass
+
+
+    def run(self):
+        """start the workers, then watch over them until told to stop."""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+
+        for i in range(len(self.workers)):
+            self.start_worker(i)
+        try:
+            while not self.stopping:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                if not self.stopping:
+                    self.check_workers()
+        finally:
+            self.shutdown()
+
+
+    def check_workers(self):
+        """restart any workers that have exited. a worker that dies soon
+        after starting waits longer each time before it is restarted."""
+        now = time.time()
+        for i, p in enumerate(self.workers):
+            if p is None:
+                if now >= self.restart_at[i]:
+                    self.start_worker(i)
+            elif p.poll() is not None:
+                if now - self.started[i] > 60:
+                    self.backoff[i] = 1
+                logger.error(f'Worker {i} PID {p.pid} exited with status {p.returncode}, '
+                             f'restart in {self.backoff[i]} seconds.')
+                self.workers[i] = None
+                self.restart_at[i] = now + self.backoff[i]
+                self.backoff[i] = min(self.backoff[i] * 2, 60)
+
+
+    def stop(self, signum, frame):
+        """signal handler for SIGINT and SIGTERM: stop the workers and exit."""
+        logger.info(f'Received {signal.Signals(signum).name}, stopping workers.')
+        self.stopping = True
+        self.wakeup.set()
+
+
+    def reload(self, signum, frame):
+        """signal handler for SIGHUP: have the workers reload the config file."""
+        logger.info('Received SIGHUP, passing it on to the workers.')
+        self.signal_workers(signal.SIGHUP)
+
+
+    def shutdown(self):
+        """terminate the workers, waiting up to 10 seconds for them to
+        exit, and remove the pid file."""
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.time() + 10
+        for i, p in enumerate(self.workers):
+            if p is None:
+                continue
+            try:
+                p.wait(max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f'Worker {i} PID {p.pid} did not exit, killing it.')
+                p.kill()
+                p.wait()
+        try:
+            os.remove(self.pid_filename)
+        except FileNotFoundError:
+            pass
+        logger.info('All workers stopped.')
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+
+import pytest
+
+# the modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+    """Stands in for the time module of the module under test. the wall
+    and monotonic clocks only move when advance() is called, together, as
+    they would when no one steps the wall clock."""
+
+    def __init__(self, now=1000000000.0):
+        self.now = now
+        self.start = now
+
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+    def set(self, now):
+        """move both clocks forward to the epoch time now."""
+        assert now >= self.now
+        self.now = now
+
+
+    def time(self):
+        return self.now
+
+
+    def monotonic(self):
+        return self.now - self.start + 1000.0
+
+
+    def localtime(self, t=None):
+        return time.localtime(self.now if t is None else t)
+
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
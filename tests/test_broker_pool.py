@@ -0,0 +1,92 @@
+import collections
+
+import broker_pool
+import publisher
+
+
+class Info:
+    """Stands in for paho's MQTTMessageInfo."""
+
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = 0
+
+
+    def is_published(self):
+        # written to the socket, but not acknowledged
+        return False
+
+
+class Client:
+    """Stands in for a paho client, recording what it publishes."""
+
+    def __init__(self):
+        self.published = []
+
+
+    def publish(self, topic, payload, qos=0):
+        self.published.append((topic, payload))
+        return Info(len(self.published))
+
+
+def make_pool(n):
+    pool = broker_pool.BrokerPool()
+    for i in range(n):
+        pool.mark_connected(pool.add(f'b{i}', 1883, Client()))
+    return pool
+
+
+KEYS = [f'r{i:04d}' for i in range(3000)]
+
+
+def test_keys_are_spread_over_the_connected_brokers():
+    pool = make_pool(3)
+    counts = collections.Counter(pool.route(key).index for key in KEYS)
+    assert sorted(counts) == [0, 1, 2]
+    assert min(counts.values()) > len(KEYS) / 3 * 0.9
+
+
+def test_only_the_keys_of_a_dropped_broker_move():
+    pool = make_pool(3)
+    before = {key: pool.route(key) for key in KEYS}
+    dropped = pool.connections[1]
+    pool.mark_disconnected(dropped)
+    for key in KEYS:
+        conn = pool.route(key)
+        assert conn.connected
+        if before[key] is not dropped:
+            assert conn is before[key]
+
+
+def test_subscription_moves_to_a_connected_broker():
+    pool = make_pool(2)
+    first, second = pool.connections
+    assert pool.subscriber is first
+    assert pool.mark_disconnected(second) is None
+    pool.mark_connected(second)
+    assert pool.mark_disconnected(first) is second
+
+
+def test_parse_brokers():
+    assert broker_pool.parse_brokers({'broker': 'a'}) == [('a', 1883)]
+    assert broker_pool.parse_brokers(
+        {'port': 8883, 'brokers': ['a', 'b:1884', {'broker': 'c', 'port': 1885}]}) == \
+        [('a', 8883), ('b', 1884), ('c', 1885)]
+
+
+def test_lost_connection_fails_only_its_own_messages():
+    pool = make_pool(2)
+    p = publisher.Publisher()
+    p.attach(pool)
+    # two remotes whose keys go to different brokers
+    a = next(key for key in KEYS if pool.route(key).index == 0)
+    b = next(key for key in KEYS if pool.route(key).index == 1)
+    p.publish(a, 'On 01', (a,), '01')
+    p.publish(b, 'On 02', (b,), '02')
+    p.flush()
+    assert pool.connections[0].client.published == [(a, 'On 01')]
+    assert pool.connections[1].client.published == [(b, 'On 02')]
+    pool.mark_disconnected(pool.connections[0])
+    p.connection_lost(pool.connections[0])
+    assert p.status(a, '01') == publisher.FAILED
+    assert p.status(b, '02') == publisher.SENT
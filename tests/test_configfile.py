@@ -0,0 +1,74 @@
+import os
+import pickle
+
+import pytest
+
+import configfile
+
+
+def test_times_with_colons_are_read_as_strings():
+    d = configfile.parse_yaml('sched: [[2:10, on, all], [18:00:30, off, all], [0705, on, sat]]')
+    assert [item[0] for item in d['sched']] == ['2:10', '18:00:30', 705]
+
+
+def test_config_is_loaded_from_the_cache_until_it_changes(tmp_path, monkeypatch):
+    config = tmp_path / 'config.yaml'
+    cache = str(tmp_path / '.config.cache')
+    config.write_text('remotes: {a: {sched: [[700, on, all]]}}\n')
+    d = configfile.load(str(config), cache)
+
+    def fail(text):
+        raise AssertionError('parsed again')
+
+    with monkeypatch.context() as m:
+        m.setattr(configfile, 'parse_yaml', fail)
+        assert configfile.load(str(config), cache) == d
+    config.write_text('remotes: {b: {sched: [[700, on, all]]}}\n')
+    assert list(configfile.load(str(config), cache)['remotes']) == ['b']
+
+
+def test_cache_from_another_version_is_ignored(tmp_path):
+    config = tmp_path / 'config.yaml'
+    cache = tmp_path / '.config.cache'
+    config.write_text('remotes: {a: {sched: [["7:00", on, all]]}}\n')
+    configfile.load(str(config), str(cache))
+    version, digest, d = pickle.loads(cache.read_bytes())
+    assert version == configfile.CACHE_VERSION
+    # an older cache, as parsed by a different loader
+    cache.write_bytes(pickle.dumps((version - 1, digest, {'stale': True})))
+    assert 'stale' not in configfile.load(str(config), str(cache))
+
+
+def test_remotes_dir_parses_only_the_files_that_changed(tmp_path, monkeypatch):
+    conf_d = tmp_path / 'conf.d'
+    conf_d.mkdir()
+    (conf_d / 'a.yaml').write_text('remotes: {a: {sched: [[700, on, all]]}}\n')
+    (conf_d / 'b.yaml').write_text('group: lights/b\nremotes: {b: {sched: [[700, on, all]]}}\n')
+    (conf_d / 'notes.txt').write_text('not a config file\n')
+    cache = str(tmp_path / '.dircache')
+    rd = configfile.RemotesDir()
+    remotes = rd.load(str(conf_d), cache)
+    assert sorted(remotes) == ['a', 'b']
+    assert remotes['b']['group'] == 'lights/b'
+
+    parsed = []
+    real = configfile.parse_remotes_file
+
+    def counting(path):
+        parsed.append(os.path.basename(path))
+        return real(path)
+
+    monkeypatch.setattr(configfile, 'parse_remotes_file', counting)
+    (conf_d / 'a.yaml').write_text('remotes: {a: {sched: [[800, on, all]]}}\n')
+    os.remove(conf_d / 'b.yaml')
+    # a new RemotesDir starts from the cache written by the first
+    remotes = configfile.RemotesDir().load(str(conf_d), cache)
+    assert parsed == ['a.yaml']
+    assert list(remotes) == ['a']
+
+
+def test_remote_in_two_files_is_rejected(tmp_path):
+    for name in ('a.yaml', 'b.yaml'):
+        (tmp_path / name).write_text('remotes: {a: {sched: [[700, on, all]]}}\n')
+    with pytest.raises(ValueError, match='more than one file'):
+        configfile.RemotesDir().load(str(tmp_path))
@@ -0,0 +1,95 @@
+import datetime
+import random
+import time
+
+import pytest
+
+import benchmark
+import controller
+
+CONFIG = """\
+mqtt:
+  broker: localhost
+remotes:
+  plain: {sched: [[0, on, all], [1200, off, all]]}
+  rand: {random: 5, sched: [[1200, off, all], [1800, on, all]]}
+"""
+
+
+def epoch(date, hour=0, minute=0, second=0.0):
+    """return the epoch time of a local time on date."""
+    t = datetime.datetime(date.year, date.month, date.day, hour, minute)
+    return time.mktime(t.timetuple()) + second
+
+
+# the controller takes the date of its first rollover from the system's,
+# so the clock starts late today.
+TODAY = datetime.date.today()
+TOMORROW = TODAY + datetime.timedelta(days=1)
+MIDNIGHT = epoch(TOMORROW)
+
+
+@pytest.fixture
+def ctl(tmp_path, clock, monkeypatch):
+    """a controller on a FakeBroker, started at 23:59:59.5 today, whose
+    clocks are the clock fixture."""
+    monkeypatch.setattr(controller, 'time', clock)
+    clock.set(MIDNIGHT - 0.5)
+    config = tmp_path / 'config.yaml'
+    config.write_text(CONFIG)
+    broker = benchmark.FakeBroker({'plain': 'lan', 'rand': 'lan'}, {}, random.Random(0))
+    args = controller.parse_args(['--config', str(config)])
+    c = benchmark.BenchController(str(tmp_path / 'timer_main.py'), args, broker)
+    c.init_controller()
+    c.tick()
+    yield c
+    c.shutdown()
+    c.log_writer.stop()
+    logger = c.log_writer.logger
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+        h.close()
+
+
+def test_startup_sends_the_state_in_effect(ctl):
+    plain = ctl.fleet.get('plain')
+    assert plain.last_sched[1] is False
+    assert ctl.scheduler.next_due() == MIDNIGHT
+    assert ctl.broker.published == 2
+
+
+def test_no_rollover_in_the_last_moments_of_the_day(ctl, clock):
+    clock.set(MIDNIGHT - 0.3)
+    ctl.tick()
+    assert ctl.rollover_date == TODAY
+    assert ctl.fleet.get('rand').date == TODAY
+    assert ctl.fleet.get('plain').last_sched[1] is False
+
+
+def test_rollover_after_midnight_dispatches_the_midnight_transition(ctl, clock):
+    clock.set(MIDNIGHT + 0.001)
+    ctl.tick()
+    assert ctl.fleet.get('plain').last_sched[1] is True
+    assert ctl.rollover_date == TOMORROW
+    rand = ctl.fleet.get('rand')
+    assert rand.date == TOMORROW
+    # the day after is prepared by the same tick
+    assert rand.next_date == TOMORROW + datetime.timedelta(days=1)
+
+
+def test_removed_remote_is_forgotten(ctl, clock, tmp_path):
+    ctl.retries.observe('rand', rssi=-50)
+    (tmp_path / 'config.yaml').write_text(CONFIG.replace('  rand:', '  # rand:'))
+    ctl.request_reload()
+    clock.advance(0.1)
+    ctl.tick()
+    assert 'rand' not in ctl.fleet
+    assert 'rand' not in ctl.retries.rtt
+
+
+def test_signal_strength_of_unknown_remotes_is_not_kept(ctl):
+    for hostname in ('plain', 'stranger'):
+        payload = f'{hostname} pong 00000000 12:00:00 -60'.encode('utf-8')
+        ctl.on_message(None, None, benchmark.FakeMessage('timer_main', payload))
+    assert ctl.retries.rtt['plain'].rssi == -60
+    assert 'stranger' not in ctl.retries.rtt
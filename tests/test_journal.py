@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+import journal
+
+SCHED = (700, 'on', 'all')
+OTHER = (2300, 'off', 'all')
+
+
+@pytest.fixture
+def journal_file(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(journal, 'time', clock)
+    return str(tmp_path / 'timer_main.journal')
+
+
+def make_journal(filename, **options):
+    j = journal.Journal()
+    j.configure(filename, **options)
+    return j
+
+
+def state(j):
+    return j.acked, j.inflight, j.offline
+
+
+def test_state_is_replayed_from_the_file(journal_file):
+    j = make_journal(journal_file)
+    j.sent('a', '01', SCHED)
+    j.ack('a', SCHED)
+    j.sent('b', '02', SCHED)
+    j.sent('c', '03', SCHED)
+    j.mark_offline('c')
+    j.sent('d', '04', OTHER)
+    j.drop('d')
+    j.flush()
+    restored = make_journal(journal_file)
+    restored.load()
+    assert state(restored) == ({'a': SCHED}, {'b': ['02', SCHED]}, {'c'})
+    assert state(restored) == state(j)
+
+
+def test_records_are_buffered_until_the_flush_interval(journal_file, clock):
+    j = make_journal(journal_file, flush_interval=10)
+    j.sent('a', '01', SCHED)
+    j.flush_if_due(clock.monotonic() + 9)
+    assert not os.path.exists(journal_file)
+    j.flush_if_due(clock.monotonic() + 10)
+    assert len(open(journal_file).readlines()) == 1
+    assert j.next_flush() is None
+
+
+def test_partly_written_last_line_is_ignored(journal_file):
+    j = make_journal(journal_file)
+    j.sent('a', '01', SCHED)
+    j.ack('a', SCHED)
+    j.flush()
+    with open(journal_file, 'a') as f:
+        f.write('{"t":"sent","h":"a","n":"02","s":[23')
+    restored = make_journal(journal_file)
+    restored.load()
+    assert state(restored) == ({'a': SCHED}, {}, set())
+
+
+def test_large_file_is_compacted_to_the_same_state(journal_file):
+    j = make_journal(journal_file, compact_size=2000)
+    for i in range(100):
+        j.sent('a', f'{i:02x}', SCHED if i % 2 else OTHER)
+        j.ack('a', SCHED if i % 2 else OTHER)
+    j.sent('b', 'ff', SCHED)
+    j.flush()
+    assert os.path.getsize(journal_file) < 2000
+    restored = make_journal(journal_file)
+    restored.load()
+    assert state(restored) == ({'a': SCHED}, {'b': ['ff', SCHED]}, set())
+
+
+def test_failed_write_backs_off_then_writes_a_snapshot(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(journal, 'time', clock)
+    filename = str(tmp_path / 'missing' / 'timer_main.journal')
+    j = make_journal(filename, flush_interval=0)
+    j.sent('a', '01', SCHED)
+    j.flush()
+    assert j.failed and j.buffer == []
+    assert j.next_flush() == clock.monotonic() + journal.JOURNAL_RETRY_MIN
+    # nothing is buffered while the write is failing
+    j.ack('a', SCHED)
+    assert j.buffer == []
+    clock.advance(journal.JOURNAL_RETRY_MIN)
+    j.flush_if_due(clock.monotonic())
+    assert j.next_flush() == clock.monotonic() + 2 * journal.JOURNAL_RETRY_MIN
+    os.mkdir(tmp_path / 'missing')
+    clock.advance(2 * journal.JOURNAL_RETRY_MIN)
+    j.flush_if_due(clock.monotonic())
+    assert not j.failed and j.next_flush() is None
+    restored = make_journal(filename)
+    restored.load()
+    assert state(restored) == ({'a': SCHED}, {}, set())
+
+
+def test_disabled_journal_records_nothing():
+    j = journal.Journal()
+    j.sent('a', '01', SCHED)
+    j.flush()
+    assert state(j) == ({}, {}, set())
@@ -0,0 +1,155 @@
+import pytest
+
+import retry
+
+SCHED = (700, 'on', 'all')
+OTHER = (2300, 'off', 'all')
+
+
+def make_manager(**policy):
+    policy = dict(dict(retries=2, initial=1.0, factor=2.0, maximum=8.0,
+                       offline_after=5.0), **policy)
+    return retry.RetryManager(**policy)
+
+
+def test_items_are_resent_with_backoff_then_expire():
+    m = make_manager()
+    item = m.add('a', '01', SCHED, 100.0)
+    assert m.expire(100.9) == ([], [])
+    assert m.expire(101.0) == ([item], [])
+    assert (item.attempts, item.retries_left) == (1, 1)
+    # the wait doubles
+    assert m.expire(102.9) == ([], [])
+    assert m.expire(103.0) == ([item], [])
+    assert item.retries_left == 0
+    # out of retries, the last wait is cut short by the offline grace period
+    assert m.next_deadline() == pytest.approx(105.0)
+    assert m.expire(105.0) == ([], [item])
+    assert len(m) == 0
+    assert m.by_host == {}
+
+
+def test_item_out_of_retries_is_resent_until_the_grace_period_ends():
+    m = make_manager(retries=0, offline_after=4.0)
+    item = m.add('a', '01', SCHED, 0.0)
+    assert m.expire(1.0) == ([item], [])
+    assert m.expire(3.0) == ([item], [])
+    assert m.next_deadline() == pytest.approx(4.0)
+    assert m.expire(4.0) == ([], [item])
+
+
+def test_weak_signal_doubles_the_grace_period():
+    m = make_manager(offline_after=5.0, weak_rssi=-80)
+    m.observe('a', rssi=-90)
+    m.observe('b', rssi=-60)
+    assert m.grace('a') == 10.0
+    assert m.grace('b') == 5.0
+    assert m.grace('c') == 5.0
+
+
+def test_ack_removes_the_item_and_samples_the_round_trip_time():
+    m = make_manager()
+    m.add('a', '01', SCHED, 10.0)
+    assert m.ack('a', '02', 10.1) is None
+    item = m.ack('a', '01', 10.2)
+    assert item.serial == '01'
+    assert len(m) == 0
+    assert m.rtt['a'].srtt == pytest.approx(0.2)
+    # an acknowledged item is not resent
+    assert m.expire(20.0) == ([], [])
+
+
+def test_resent_item_does_not_sample_the_round_trip_time():
+    m = make_manager()
+    m.add('a', '01', SCHED, 10.0)
+    m.expire(11.0)
+    assert m.ack('a', '01', 11.5) is not None
+    assert 'a' not in m.rtt
+
+
+def test_new_schedule_supersedes_the_one_in_flight():
+    m = make_manager(max_inflight=2)
+    old = m.add('a', '01', SCHED, 0.0)
+    m.add('a', '02', OTHER, 0.1)
+    assert old.cancelled
+    assert list(m.by_host['a']) == ['02']
+    assert len(m) == 1
+
+
+def test_number_in_flight_is_capped():
+    m = make_manager(max_inflight=2)
+    first = m.add('a', '01', SCHED, 0.0)
+    m.add('a', '02', SCHED, 0.1)
+    m.add('a', '03', SCHED, 0.2)
+    assert first.cancelled
+    assert list(m.by_host['a']) == ['02', '03']
+    # an ack for one confirms the other for the same schedule
+    m.ack('a', '03', 0.3)
+    assert len(m) == 0 and 'a' not in m.by_host
+
+
+def test_cancel_host_and_forget():
+    m = make_manager()
+    m.add('a', '01', SCHED, 0.0)
+    m.add('b', '02', SCHED, 0.0)
+    m.observe('a', rtt=0.1)
+    m.ping_sent('a', '03', 0.0)
+    m.cancel_host('a')
+    m.forget('a')
+    assert len(m) == 1
+    assert 'a' not in m.rtt and 'a' not in m.pings
+    resend, exhausted = m.expire(1.0)
+    assert [item.hostname for item in resend] == ['b']
+
+
+def test_pong_samples_only_the_last_ping():
+    m = make_manager()
+    m.ping_sent('a', '01', 5.0)
+    m.pong('a', '02', 5.1)
+    assert 'a' not in m.rtt
+    m.ping_sent('a', '03', 6.0)
+    m.pong('a', '03', 6.05)
+    assert m.rtt['a'].srtt == pytest.approx(0.05)
+
+
+def test_invalid_policy_is_rejected():
+    with pytest.raises(ValueError):
+        make_manager(initial=10.0, maximum=5.0)
+
+
+def test_timing_wheel_keeps_items_beyond_one_revolution():
+    wheel = retry.TimingWheel(resolution=1.0, slots=8)
+    wheel.expire(0.0)
+    near = retry.RetryItem('a', '01', SCHED, 0, 0.0)
+    far = retry.RetryItem('b', '02', SCHED, 0, 0.0)
+    wheel.add(near, 3.0)
+    # shares a slot with near
+    wheel.add(far, 11.0)
+    assert wheel.next_deadline() == 3.0
+    assert wheel.expire(3.0) == [near]
+    assert wheel.next_deadline() == 11.0
+    assert wheel.expire(10.0) == []
+    assert wheel.expire(11.0) == [far]
+    assert wheel.next_deadline() is None
+
+
+def test_timing_wheel_catches_up_after_falling_behind():
+    wheel = retry.TimingWheel(resolution=1.0, slots=8)
+    wheel.expire(0.0)
+    items = [retry.RetryItem('a', str(i), SCHED, 0, 0.0) for i in range(5)]
+    for i, item in enumerate(items):
+        wheel.add(item, 2.0 + 3 * i)
+    # more than a revolution later, every item is due
+    assert sorted(wheel.expire(100.0), key=lambda item: item.serial) == items
+    assert wheel.count == 0
+
+
+def test_timing_wheel_drops_cancelled_items():
+    wheel = retry.TimingWheel(resolution=1.0, slots=8)
+    wheel.expire(0.0)
+    item = retry.RetryItem('a', '01', SCHED, 0, 0.0)
+    wheel.add(item, 2.0)
+    item.cancelled = True
+    assert wheel.next_deadline() is None
+    assert wheel.expire(5.0) == []
+    assert wheel.count == 0
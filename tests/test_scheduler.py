@@ -0,0 +1,104 @@
+import datetime
+import time
+
+import pytest
+
+import remote
+import scheduler
+
+
+def epoch(date, hour=0, minute=0, second=0.0):
+    """return the epoch time of a local time on date."""
+    t = datetime.datetime(date.year, date.month, date.day, hour, minute)
+    return time.mktime(t.timetuple()) + second
+
+
+# a Wednesday well away from any change to or from daylight saving time
+WED = datetime.date(2026, 6, 10)
+
+
+def make_remote(name, sched, date=None, **props):
+    r = remote.Remote(name, dict(props, sched=sched), date=date)
+    assert r.name == name, r.error_msg
+    return r
+
+
+def test_now_sow_takes_the_second_that_has_started():
+    t = epoch(WED, 7, 0, 0.9)
+    assert remote.now_sow(t) == 2 * remote.SECONDS_PER_DAY + 7 * 3600
+    assert remote.now_sow(t + 0.2) == 2 * remote.SECONDS_PER_DAY + 7 * 3600 + 1
+
+
+def test_transition_time_counts_from_the_start_of_the_second():
+    now = epoch(WED, 7, 0, 0.7)
+    assert scheduler.transition_time(60, now) == epoch(WED, 7, 1)
+    assert scheduler.transition_time(0, now) == epoch(WED, 7)
+
+
+def test_remote_is_not_processed_before_its_transition():
+    r = make_remote('a', [[700, 'on', 'all'], [2300, 'off', 'all']])
+    assert r.process(remote.now_sow(epoch(WED, 6, 59, 59.9)))[1] == 'off'
+    assert r.process(remote.now_sow(epoch(WED, 7)))[1] == 'on'
+    # unchanged since the last call
+    assert r.process(remote.now_sow(epoch(WED, 7, 0, 30))) == []
+
+
+def test_pop_due_returns_remotes_at_their_transition():
+    sch = scheduler.TransitionScheduler()
+    a = make_remote('a', [[700, 'on', 'all'], [2300, 'off', 'all']])
+    b = make_remote('b', [[800, 'on', 'all'], [2300, 'off', 'all']])
+    now = epoch(WED, 6)
+    sch.schedule(a, now)
+    sch.schedule(b, now)
+    assert len(sch) == 2
+    assert sch.next_due() == epoch(WED, 7)
+    # a timed wait may return a moment early
+    assert sch.pop_due(epoch(WED, 7) - 2 * scheduler.DUE_TOLERANCE) == []
+    assert sch.pop_due(epoch(WED, 7) - scheduler.DUE_TOLERANCE / 2) == [a]
+    assert sch.pop_due(epoch(WED, 8, 0, 0.25)) == [b]
+    assert sch.last_lateness == pytest.approx(0.25)
+    assert sch.stats.count == 2
+    assert len(sch) == 0 and sch.next_due() is None
+
+
+def test_rescheduled_and_removed_remotes_leave_stale_entries_behind():
+    sch = scheduler.TransitionScheduler()
+    a = make_remote('a', [[700, 'on', 'all'], [2300, 'off', 'all']])
+    b = make_remote('b', [[800, 'on', 'all'], [2300, 'off', 'all']])
+    sch.schedule(a, epoch(WED, 6))
+    sch.schedule(b, epoch(WED, 6))
+    # the earlier entry for a is superseded
+    sch.schedule(a, epoch(WED, 7, 30))
+    assert sch.next_due() == epoch(WED, 8)
+    sch.remove(b)
+    assert sch.next_due() == epoch(WED, 23)
+    assert sch.pop_due(epoch(WED, 23)) == [a]
+
+
+def test_schedule_now_is_due_at_once_and_not_counted_as_late():
+    sch = scheduler.TransitionScheduler()
+    a = make_remote('a', [[700, 'on', 'all']])
+    now = epoch(WED, 12)
+    sch.schedule_now(a, now)
+    assert sch.pop_due(now + 5) == [a]
+    assert sch.last_lateness is None
+    assert sch.stats.count == 0
+
+
+def test_randomized_week_rolls_over_to_the_prepared_one():
+    r = make_remote('a', [[0, 'on', 'all'], [1200, 'off', 'all']], random=30)
+    r.rollover(WED)
+    thu = WED + datetime.timedelta(days=1)
+    r.prepare(thu)
+    prepared = r.next_compiled
+    r.rollover(thu)
+    assert r.date == thu
+    assert r.compiled is prepared
+    assert r.next_date is None
+    # the same seed, name and date give the same times
+    again = make_remote('a', [[0, 'on', 'all'], [1200, 'off', 'all']], random=30, date=thu)
+    assert list(again.compiled.seconds) == list(r.compiled.seconds)
+    # a time pushed before midnight is clamped to 00:00 of the same
+    # day, so each day keeps both of its items
+    days = [t // remote.SECONDS_PER_DAY for t in r.compiled.seconds]
+    assert sorted(days) == sorted(list(range(7)) * 2)
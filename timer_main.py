@@ -1,19 +1,34 @@
 #!/home/jack/.venv/bin/python3
 
+import asyncio
 import logging
 import signal
 import sys
-import time
-import yaml
 
 import controller as timer
 
 def main():
     global controller
     global logger
-    controller = timer.Controller(__file__)
+    args = timer.parse_args()
+    # with --workers, run a supervisor that starts a worker process for
+    # each shard of the remotes, each running the code below.
+    if args.workers > 1 and args.shard is None and not args.syntax:
+        import supervisor
+        supervisor.Supervisor(__file__, args).run()
+        return
+    if args.asyncio:
+        import async_controller
+        controller = async_controller.AsyncController(__file__, args)
+    else:
+        controller = timer.Controller(__file__, args)
     logger = logging.getLogger('timer_main')
 
+    # with --asyncio, mqtt, timers and signals all run on one event loop
+    if args.asyncio:
+        asyncio.run(controller.run())
+        return
+
     # register the signal handlers
     signal.signal(signal.SIGINT,  sigint_handler)
     signal.signal(signal.SIGTERM, sigterm_handler)
@@ -21,32 +36,19 @@ def main():
 
     # initialize
     controller.init_controller()
-    last_mday = time.localtime().tm_mday
-    controller.sleep_minute()
 
-    # main loop
+    # main loop. while no broker is connected, state changes wait in
+    # the publisher, to be sent on whichever broker connects first.
     while True:
-        if controller.mqtt_connected:
-            t = time.localtime(time.time() + 0.5)   # round up fractional seconds
-            # time for the daily reprocess? (to generate any new random times)
-            if t.tm_mday != last_mday:
-                last_mday = t.tm_mday
-                logger.debug(f'Starting daily schedule reprocess.')
-                controller.init_controller()
-                logger.debug(f'Reprocess complete.')
-            else:
-                controller.process_retries()
-                controller.process()
-            controller.sleep_minute()
-        else:
-            time.sleep(1)
+        controller.tick()
+        controller.sleep_until_due()
 
 
 # signal handler for SIGINT: terminate program
 def sigint_handler(signal, frame):
     global logger
     logger.info('Received SIGINT, exiting.')
-    controller.remove_pidfile()
+    controller.shutdown()
     sys.exit(0)
 
 
@@ -54,7 +56,7 @@ def sigint_handler(signal, frame):
 def sigterm_handler(signal, frame):
     global logger
     logger.info('Received SIGTERM, exiting.')
-    controller.remove_pidfile()
+    controller.shutdown()
     sys.exit(0)
 
 
@@ -63,7 +65,7 @@ def sighup_handler(signal, frame):
     global controller
     global logger
     logger.info('Received SIGHUP, reloading configuration.')
-    controller.init_controller()
+    controller.request_reload()
 
 
 if __name__ == '__main__':